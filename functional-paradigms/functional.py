@@ -1,16 +1,343 @@
+import bisect
+import collections
 import csv
 import functools
+import itertools
+import math
+import mmap
+import os
 
-from io import BytesIO
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from io import BytesIO, TextIOWrapper
 from tarfile import open as tar_open
 from zipfile import ZipFile
 
 
-def file_to_rows(filename):
+def file_to_rows(filename, processes=None, ordered=True, chunksize=1 << 20):
+    """Yield the rows of a delimited file, or of every member of an archive.
+
+    By default the file is read and parsed as a stream in this process.
+    Given `processes` (0 for one per core), it is cut into blocks of about
+    `chunksize` bytes, each ending at the end of a line, and the blocks are
+    parsed on a pool of that many worker processes; a row that runs across
+    two blocks, in a quoted field with a line break, is parsed again where
+    they meet.  Rows come out in file order or, with `ordered=False`, an
+    archive's members come out as they finish.
+    """
+    extensions = _extensions_from_filename(filename)
+    extension = (extensions or [None])[-1]
+    pooled = processes not in (None, 1)
+    if extension in _MEMBERS_BY_EXTENSION:
+        members = _MEMBERS_BY_EXTENSION[extension]
+        if pooled:
+            blocks = _archive_blocks(filename, members, chunksize)
+            yield from _pooled_rows(_block_to_rows, blocks, processes, ordered, lambda *block: block)
+            return
+        for name, fin in members(filename):
+            yield from _execute_pipeline(_build_pipeline(_member_parsed_as(filename, name)), fin)
+        return
+    if pooled and len(extensions) == 1 and os.path.getsize(filename):
+        yield from _pooled_rows(_range_to_rows, _file_ranges(filename, chunksize), processes, ordered, _range_block)
+        return
     with open(filename, 'rb') as fin:
         yield from _execute_pipeline(_build_pipeline(filename), fin)
 
 
+Categorical = collections.namedtuple('Categorical', 'codes categories')
+
+
+def rows_to_columns(rows, dtypes=None, batchsize=65536, numpy=False):
+    """Yield rows, e.g. those of file_to_rows, as batches of typed columns.
+
+    A batch is a list of columns of up to `batchsize` values each.  `dtypes`
+    gives each column one of 'int' or 'float', which come out as arrays,
+    'str', which comes out as a list, or 'category', which comes out as a
+    Categorical of codes into categories shared by every batch.  Columns
+    without a dtype are given one from the whole first batch, and if a later
+    value doesn't fit it, it is widened from int to float (an empty field is
+    NaN) to str for that batch and the ones after.  With `numpy=True` the
+    arrays are NumPy arrays over the same memory.
+    """
+    converters = None
+    for columns in _rows_to_column_values(rows, batchsize, len(dtypes) if dtypes else None):
+        if converters is None:
+            given = list(dtypes or [None] * len(columns))
+            dtypes = [dtype or _inferred_dtype(values) for dtype, values in zip(given, columns)]
+            converters = [_CONVERTERS_BY_DTYPE[dtype]() for dtype in dtypes]
+        batch = []
+        for index, values in enumerate(columns):
+            while True:
+                try:
+                    batch.append(converters[index](values))
+                    break
+                except (ValueError, OverflowError):
+                    if given[index] or dtypes[index] not in _WIDER_DTYPES:
+                        raise
+                    dtypes[index] = _WIDER_DTYPES[dtypes[index]]
+                    converters[index] = _CONVERTERS_BY_DTYPE[dtypes[index]]()
+        yield _numpy_columns(batch) if numpy else batch
+
+
+def _pooled_rows(function, tasks, processes, ordered, task_block):
+    # blocks end at plain line ends, which may fall inside a quoted field: a
+    # worker parses its block as if it starts a row and sends back the lines
+    # of a row the block leaves open, and only the rows across such a cut are
+    # parsed again, here, until they line up with the next block's own rows
+    tails = {}
+    for (chain, last), task, (fields, widths, ends, tail) in _pooled_results(function, tasks, processes, ordered):
+        rows = _unpacked_rows(fields, widths)
+        if chain in tails:
+            rows, tail = _stitched_rows(tails.pop(chain), *task_block(*task), rows, ends, tail)
+        yield from rows
+        if tail is not None and last:
+            # a quoted field still open at the end runs to the end, as it
+            # does when the file is parsed serially
+            yield from (row for row, _, _ in _counted_rows(tail, _delimiter(task[0])))
+        elif tail is not None:
+            tails[chain] = tail
+
+
+def _pooled_results(function, tasks, processes, ordered):
+    processes = processes or os.cpu_count()
+    with ProcessPoolExecutor(processes) as pool:
+        # only a few blocks are in flight at once, so a big bundle or file
+        # isn't read into memory ahead of the workers
+        pending = collections.deque()
+        for key, task in tasks:
+            pending.append((key, task, pool.submit(function, *task)))
+            while len(pending) >= 2 * processes:
+                yield from _finished_results(pending, ordered)
+        while pending:
+            yield from _finished_results(pending, ordered)
+
+
+def _finished_results(pending, ordered):
+    if ordered:
+        key, task, future = pending.popleft()
+        yield key, task, future.result()
+        return
+    # the blocks of one member, or of a plain file, still come out in order,
+    # since the rows of one can depend on the one before it
+    heads = {}
+    for entry in pending:
+        heads.setdefault(entry[0][0], entry)
+    done, _ = wait([future for _, _, future in heads.values()], return_when=FIRST_COMPLETED)
+    for key, task, future in heads.values():
+        if future in done:
+            pending.remove((key, task, future))
+            yield key, task, future.result()
+
+
+def _member_parsed_as(filename, name):
+    # members are parsed by their own extensions if they have any we know,
+    # otherwise by those of the archive itself, e.g. abc.csv.zip
+    extensions = _extensions_from_filename(name)
+    if extensions and all(extension in _STAGES_BY_EXTENSION for extension in extensions):
+        return name
+    return filename.rsplit('.', 1)[0]
+
+
+def _archive_blocks(filename, members, chunksize):
+    # members are decompressed here, in order, and handed to the workers a
+    # block at a time; each member's blocks are a chain of their own
+    for index, (name, fin) in enumerate(members(filename)):
+        parsed_as = _member_parsed_as(filename, name)
+        for block, last in _stream_blocks(fin, chunksize):
+            yield (index, last), (parsed_as, block)
+
+
+def _stream_blocks(fin, chunksize):
+    # each block with whether it is the last one
+    buffer, block = bytearray(), None
+    for data in iter(lambda: fin.read(chunksize), b''):
+        buffer += data
+        end = buffer.find(b'\n', chunksize - 1) + 1
+        while end:
+            if block is not None:
+                yield block, False
+            block = bytes(buffer[:end])
+            del buffer[:end]
+            end = buffer.find(b'\n', chunksize - 1) + 1
+    if buffer:
+        if block is not None:
+            yield block, False
+        block = bytes(buffer)
+    if block is not None:
+        yield block, True
+
+
+def _file_ranges(filename, chunksize):
+    with open(filename, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        start = 0
+        while start < len(content):
+            end = content.find(b'\n', start + chunksize - 1) + 1 or len(content)
+            yield (filename, end == len(content)), (filename, start, end)
+            start = end
+
+
+def _range_block(filename, start, end):
+    with open(filename, 'rb') as fin, mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        return filename, content[start:end]
+
+
+def _range_to_rows(filename, start, end):
+    return _block_to_rows(*_range_block(filename, start, end))
+
+
+def _block_to_rows(parsed_as, block):
+    if not _extensions_from_filename(parsed_as):
+        # a member of no type we know comes back as its lines of bytes
+        return list(_execute_pipeline(_build_pipeline(parsed_as), BytesIO(block))), None, None, None
+    lines = list(_bytes_to_text(BytesIO(block)))
+    rows, ends, tail = [], array('q'), None
+    for row, read, cut in _counted_rows(lines, _delimiter(parsed_as)):
+        if cut:
+            tail = lines[ends[-1] if ends else 0:]
+            break
+        rows.append(row)
+        ends.append(read)
+    return _packed_rows(rows) + (ends, tail)
+
+
+def _stitched_rows(tail, parsed_as, block, rows, ends, block_tail):
+    # parse on from the lines left open into the block's own, until a row
+    # ends where one of the worker's did: its rows after that are right
+    lines = tail + list(_bytes_to_text(BytesIO(block)))
+    stitched, done = [], 0
+    for row, read, cut in _counted_rows(lines, _delimiter(parsed_as)):
+        if cut:
+            return stitched, lines[done:]
+        stitched.append(row)
+        done = read
+        index = bisect.bisect_left(ends, read - len(tail))
+        if index < len(ends) and ends[index] == read - len(tail):
+            return itertools.chain(stitched, itertools.islice(rows, index + 1, None)), block_tail
+    return stitched, None
+
+
+def _counted_rows(lines, delimiter):
+    # rows read from lines as the serial pipeline reads them, each with how
+    # many lines had been read when it ended and whether they ran out first,
+    # inside a quoted field
+    read, out = 0, False
+
+    def counted():
+        nonlocal read, out
+        for line in lines:
+            read += 1
+            line = line.rstrip('\r\n')
+            if line:
+                yield line
+        out = True
+
+    for row in csv.reader(counted(), delimiter=delimiter):
+        yield row, read, out
+
+
+def _delimiter(filename):
+    return _DELIMITERS_BY_EXTENSION[_extensions_from_filename(filename)[-1]]
+
+
+def _packed_rows(rows):
+    # rows go back from a worker as their fields joined by NULs, and split
+    # again here in one call, which is several times faster to unpickle than
+    # a list of lists; fields with a NUL in them go back as a flat list
+    fields, widths = [], array('q')
+    for row in rows:
+        fields.extend(row)
+        widths.append(len(row))
+    joined = '\0'.join(fields)
+    if joined.count('\0') == len(fields) - 1:
+        fields = joined
+    return fields, widths
+
+
+def _unpacked_rows(fields, widths):
+    if widths is None:
+        return iter(fields)
+    if not widths:
+        return iter(())
+    if isinstance(fields, str):
+        fields = fields.split('\0')
+    if min(widths) == max(widths):
+        return map(list, zip(*[iter(fields)] * widths[0]))
+    starts = itertools.accumulate(widths, initial=0)
+    return (fields[start:start + width] for start, width in zip(starts, widths))
+
+
+def _rows_to_column_values(rows, batchsize, width):
+    # a batch's values are gathered a small piece of rows at a time, so only
+    # a piece of row lists is alive at once: holding a whole batch of them
+    # keeps the garbage collector walking them, which costs more than parsing
+    rows = iter(rows)
+    while True:
+        batch = itertools.islice(rows, batchsize)
+        columns = None
+        for piece in iter(lambda: list(itertools.islice(batch, _ROWS_PER_PIECE)), []):
+            width = width or max(map(len, piece))
+            if columns is None:
+                columns = [[] for _ in range(width)]
+            for column, values in zip(columns, _piece_to_values(piece, width)):
+                column.extend(values)
+        if columns is None:
+            return
+        yield columns
+
+
+def _piece_to_values(piece, width):
+    if set(map(len, piece)) != {width}:
+        # short rows are padded with empty fields and long ones cut to width
+        piece = [list(row[:width]) + [''] * (width - len(row)) for row in piece]
+    return zip(*piece)
+
+
+def _inferred_dtype(values):
+    if not any(values):
+        return 'str'
+    for dtype in ('int', 'float'):
+        try:
+            _CONVERTERS_BY_DTYPE[dtype]()(values)
+            return dtype
+        except (ValueError, OverflowError):
+            pass
+    return 'category' if len(set(values)) * 2 <= len(values) else 'str'
+
+
+def _values_to_ints(values):
+    return array('q', map(int, values))
+
+
+def _values_to_floats(values):
+    try:
+        return array('d', map(float, values))
+    except ValueError:
+        # empty fields are missing values; anything else still raises
+        return array('d', (float(value) if value else math.nan for value in values))
+
+
+def _values_to_categorical():
+    index = {}
+
+    def convert(values):
+        for value in dict.fromkeys(values):
+            index.setdefault(value, len(index))
+        return Categorical(array('l', map(index.__getitem__, values)), list(index))
+
+    return convert
+
+
+def _numpy_columns(columns):
+    import numpy
+    return [
+        Categorical(numpy.frombuffer(column.codes, dtype=column.codes.typecode), column.categories)
+        if isinstance(column, Categorical) else
+        numpy.frombuffer(column, dtype=column.typecode) if isinstance(column, array) else
+        column
+        for column in columns
+    ]
+
+
 def _build_pipeline(filename):
     return (
         stage
@@ -20,29 +347,35 @@ def _build_pipeline(filename):
 
 
 def _extensions_from_filename(filename):
-    return filename.split('.')[1:]
+    return os.path.basename(filename).split('.')[1:]
 
 
 def _execute_pipeline(pipeline, fin):
-    return functools.reduce(lambda content, stage: stage(content), pipeline, fin.read())
+    # every stage takes and returns a stream, so nothing is read until rows are
+    return functools.reduce(lambda content, stage: stage(content), pipeline, fin)
 
 
-def _bytes_tgz_to_bytes(content):
-    archive = tar_open(fileobj=BytesIO(content), mode='r:gz')
-    return archive.extractfile(archive.getmembers()[0]).read()
+def _tgz_members(filename):
+    with tar_open(filename, mode='r:gz') as archive:
+        for member in archive:
+            if member.isfile():
+                yield member.name, archive.extractfile(member)
 
 
-def _bytes_zip_to_bytes(content):
-    archive = ZipFile(BytesIO(content))
-    return archive.read(archive.namelist()[0])
+def _zip_members(filename):
+    with ZipFile(filename) as archive:
+        for info in archive.infolist():
+            if not info.is_dir():
+                with archive.open(info) as fin:
+                    yield info.filename, fin
 
 
 def _bytes_to_text(content):
-    return bytes.decode(content, encoding='utf-8')
+    return TextIOWrapper(content, encoding='utf-8', newline='')
 
 
 def _text_to_lines(content):
-    return str.splitlines(content)
+    return (line.rstrip('\r\n') for line in content)
 
 
 def _lines_to_filtered_lines(content):
@@ -67,13 +400,29 @@ _STAGES_BY_EXTENSION = dict(
     csv=_BYTES_TO_FILTERED_LINES + (_lines_csv_to_rows,),
     psv=_BYTES_TO_FILTERED_LINES + (_lines_psv_to_rows,),
     tsv=_BYTES_TO_FILTERED_LINES + (_lines_tsv_to_rows,),
-    tgz=(_bytes_tgz_to_bytes,),
-    zip=(_bytes_zip_to_bytes,),
+)
+
+_ROWS_PER_PIECE = 1024
+
+_DELIMITERS_BY_EXTENSION = dict(csv=',', psv='|', tsv='\t')
+
+_WIDER_DTYPES = dict(int='float', float='str')
+
+_CONVERTERS_BY_DTYPE = dict(
+    int=lambda: _values_to_ints,
+    float=lambda: _values_to_floats,
+    str=lambda: list,
+    category=_values_to_categorical,
+)
+
+_MEMBERS_BY_EXTENSION = dict(
+    tgz=_tgz_members,
+    zip=_zip_members,
 )
 
 # partial functions doing the same thing as the functions above:
-# _bytes_to_text = functools.partial(bytes.decode, encoding='utf-8')
-# _text_to_lines = str.splitlines
+# _bytes_to_text = functools.partial(TextIOWrapper, encoding='utf-8', newline='')
+# _text_to_lines = functools.partial(map, operator.methodcaller('rstrip', '\r\n'))
 # _lines_to_filtered_lines = functools.partial(filter, None)
 # _lines_csv_to_rows = csv.reader
 # _lines_psv_to_rows = functools.partial(csv.reader, delimiter='|')
@@ -1,25 +1,192 @@
+import collections
+import collections.abc
 import csv
+import hashlib
+import itertools
+import json
+import math
+import mmap
+import os
+import struct
 
-from io import BytesIO
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from tarfile import open as tar_open
+from tempfile import mkstemp
 from zipfile import ZipFile
 
 
 class Unzipper():
 
-    def decompress(self, content):
-        archive = ZipFile(BytesIO(content))
-        file = archive.namelist()[0]
-        with open(file, 'rb') as fin:
-            return fin.read()
+    def members(self, filename):
+        with ZipFile(filename) as archive:
+            return [(name, None) for name in archive.namelist() if not name.endswith('/')]
+
+    def decompress(self, filename, name, content):
+        with ZipFile(filename) as archive:
+            return archive.read(name)
+
+
+class Untarrer():
+
+    def members(self, filename):
+        with tar_open(filename, mode='r:gz') as archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member).read()
+
+    def decompress(self, filename, name, content):
+        return content
+
+
+class Snapshot(collections.abc.Sequence):
+
+    # a header, then each row's fields as UTF-8 joined by NULs, then where
+    # each row starts, then as JSON any rows that can't be joined that way
+    # (no fields, or a NUL in one), so rows come straight out of the mapped
+    # file with one decode and one split each
+    _HEADER = struct.Struct('<8sQQQ')
+    _MAGIC = b'ROWS0001'
+
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as fin:
+            self._map = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, rows, blobsize, oddsize = self._HEADER.unpack_from(self._map)
+        if magic != self._MAGIC:
+            raise ValueError(f'{path} is not a snapshot')
+        offset = self._HEADER.size + blobsize
+        self._starts = memoryview(self._map)[offset:offset + 8 * (rows + 1)].cast('Q')
+        offset += 8 * (rows + 1)
+        self._odd = {index: row for index, row in json.loads(self._map[offset:offset + oddsize])}
+
+    def __repr__(self):
+        return f"Snapshot(path='{self._path}')"
+
+    def __len__(self):
+        return len(self._starts) - 1
+
+    def __eq__(self, other):
+        if not isinstance(other, collections.abc.Sequence) or isinstance(other, (str, bytes)):
+            return NotImplemented
+        return len(self) == len(other) and all(mine == theirs for mine, theirs in zip(self, other))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # a slice of a snapshot is a list of its rows, as with a list
+            return list(map(self.__getitem__, range(len(self))[index]))
+        if not -len(self) <= index < len(self):
+            raise IndexError('snapshot index out of range')
+        index %= len(self)
+        if index in self._odd:
+            return list(self._odd[index])
+        offset = self._HEADER.size
+        return self._map[offset + self._starts[index]:offset + self._starts[index + 1]].decode('utf-8').split('\0')
+
+    def __iter__(self):
+        if self._odd:
+            yield from map(self.__getitem__, range(len(self)))
+            return
+        offset, content = self._HEADER.size, self._map
+        for start, end in zip(self._starts, self._starts[1:]):
+            yield content[offset + start:offset + end].decode('utf-8').split('\0')
+
+    @classmethod
+    def write(cls, path, rows):
+        starts, odd = array('Q', [0]), []
+        with open(path, 'wb') as fout:
+            fout.write(cls._HEADER.pack(cls._MAGIC, 0, 0, 0))
+            for index, row in enumerate(rows):
+                joined = '\0'.join(row)
+                if not row or joined.count('\0') != len(row) - 1:
+                    odd.append([index, list(row)])
+                    joined = ''
+                starts.append(starts[-1] + fout.write(joined.encode('utf-8')))
+            # keep the row starts that follow aligned for the cast on reload
+            blobsize = starts[-1] + fout.write(bytes(-starts[-1] % 8))
+            fout.write(starts)
+            oddsize = fout.write(json.dumps(odd).encode('utf-8'))
+            fout.seek(0)
+            fout.write(cls._HEADER.pack(cls._MAGIC, len(starts) - 1, blobsize, oddsize))
+
+
+class RowCache():
+
+    def __init__(self, directory=None, maxbytes=1 << 30):
+        self._directory = directory or os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache')), 'file_to_rows'
+        )
+        self._maxbytes = maxbytes
+        os.makedirs(self._directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"RowCache(directory='{self._directory}', maxbytes={self._maxbytes})"
+
+    def directory(self):
+        return self._directory
+
+    def snapshot(self, filename, rows):
+        # rows() is only called to parse the file if no snapshot of it as it
+        # is now is cached; the key changes with the path, size, mtime or content
+        path = os.path.join(self._directory, self._key(filename) + '.rows')
+        try:
+            # the modification time of a snapshot is when it was last used
+            os.utime(path)
+        except FileNotFoundError:
+            fd, temp = mkstemp(dir=self._directory, suffix='.tmp')
+            os.close(fd)
+            try:
+                Snapshot.write(temp, rows())
+                os.replace(temp, path)
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+            self._evict(keep=path)
+        return Snapshot(path)
+
+    def _key(self, filename):
+        stat = os.stat(filename)
+        content = hashlib.blake2b()
+        with open(filename, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                content.update(block)
+        key = f'{os.path.abspath(filename)}\0{stat.st_size}\0{stat.st_mtime_ns}\0{content.hexdigest()}'
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=20).hexdigest()
+
+    def _evict(self, keep):
+        snapshots = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.rows'):
+                try:
+                    snapshots.append((entry.stat().st_mtime_ns, entry.stat().st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+        total = sum(size for _, size, _ in snapshots)
+        for _, size, path in sorted(snapshots):
+            if total <= self._maxbytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
 
 
 class FileToRows():
 
-    def __init__(self, filename):
+    _DECOMPRESSORS = dict(zip=Unzipper, tgz=Untarrer)
+
+    def __init__(self, filename, processes=None, ordered=True, cache=None):
         self._filename = filename
-        parts = filename.split('.')
+        parts = os.path.basename(filename).split('.')
         self._name, self._extensions = parts[0], parts[1:]
-        self._decompressor = Unzipper() if self._extensions[-1] == 'zip' else None
+        decompressor = self._DECOMPRESSORS.get(self._extensions[-1]) if self._extensions else None
+        self._decompressor = decompressor() if decompressor else None
+        self._processes = processes
+        self._ordered = ordered
+        self._cache = cache
 
     def __repr__(self):
         return f"FileToRows(filename='{self._filename}')"
@@ -33,14 +200,211 @@ class FileToRows():
     def rows(self):
         return list(self)
 
+    def snapshot(self):
+        # the rows as they are cached, read lazily from the mapped file
+        if not self._cache:
+            raise ValueError(f'{self!r} has no cache to snapshot into')
+        return self._snapshot()
+
+    def columns(self, dtypes=None, batchsize=65536, numpy=False):
+        return RowsToColumns(self, dtypes, batchsize, numpy)
+
     def __iter__(self):
+        if self._cache:
+            yield from self._snapshot()
+            return
+        yield from self._parsed_rows()
+
+    def _snapshot(self):
+        return self._cache.snapshot(self._filename, self._parsed_rows)
+
+    def _parsed_rows(self):
+        if self._decompressor:
+            yield from self._members_to_rows()
+            return
         with open(self._filename, 'rb') as fin:
             content = fin.read()
-            if self._decompressor:
-                content = self._decompressor.decompress(content)
-            content = content.decode('utf-8')
-            for row in self._text_to_rows(content):
-                yield row
+            yield from self._content_to_rows(content)
+
+    def _members_to_rows(self):
+        tasks = (
+            (self._decompressor, self._filename, name, content)
+            for name, content in self._decompressor.members(self._filename)
+        )
+        if self._processes in (None, 1):
+            for task in tasks:
+                yield from FileToRows._member_to_rows(task)
+            return
+        processes = self._processes or os.cpu_count()
+        with ProcessPoolExecutor(processes) as pool:
+            # only a few members are in flight at once, so a big archive isn't
+            # read into memory ahead of the workers
+            pending = collections.deque()
+            for task in tasks:
+                pending.append(pool.submit(FileToRows._member_to_rows, task))
+                while len(pending) >= 2 * processes:
+                    yield from self._finished_rows(pending)
+            while pending:
+                yield from self._finished_rows(pending)
 
-    def _text_to_rows(self, content):
+    def _finished_rows(self, pending):
+        if self._ordered:
+            yield from pending.popleft().result()
+            return
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+            yield from future.result()
+
+    @staticmethod
+    def _member_to_rows(task):
+        decompressor, filename, name, content = task
+        return list(FileToRows._content_to_rows(decompressor.decompress(filename, name, content)))
+
+    @staticmethod
+    def _content_to_rows(content):
+        return FileToRows._text_to_rows(content.decode('utf-8'))
+
+    @staticmethod
+    def _text_to_rows(content):
         return csv.reader(line for line in content.split() if line)
+
+
+class Categorical():
+
+    def __init__(self, codes, categories):
+        self.codes = codes
+        self.categories = categories
+
+    def __repr__(self):
+        return f'Categorical(codes={self.codes!r}, categories={self.categories!r})'
+
+    def __len__(self):
+        return len(self.codes)
+
+
+class IntColumn():
+
+    def convert(self, values):
+        return array('q', map(int, values))
+
+
+class FloatColumn():
+
+    def convert(self, values):
+        try:
+            return array('d', map(float, values))
+        except ValueError:
+            # empty fields are missing values; anything else still raises
+            return array('d', (float(value) if value else math.nan for value in values))
+
+
+class StrColumn():
+
+    def convert(self, values):
+        return list(values)
+
+
+class CategoryColumn():
+
+    def __init__(self):
+        self._index = {}
+
+    def convert(self, values):
+        for value in dict.fromkeys(values):
+            self._index.setdefault(value, len(self._index))
+        return Categorical(array('l', map(self._index.__getitem__, values)), list(self._index))
+
+
+class RowsToColumns():
+
+    _COLUMNS = dict(int=IntColumn, float=FloatColumn, str=StrColumn, category=CategoryColumn)
+
+    # an inferred column whose values stop fitting its dtype is widened
+    _WIDER = dict(int='float', float='str')
+
+    # batches are built up from pieces this many rows long, so the garbage
+    # collector never has a whole batch of row lists to walk
+    _ROWS_PER_PIECE = 1024
+
+    def __init__(self, rows, dtypes=None, batchsize=65536, numpy=False):
+        self._rows = rows
+        self._dtypes = list(dtypes) if dtypes else None
+        self._given = list(self._dtypes) if dtypes else None
+        self._batchsize = batchsize
+        self._numpy = numpy
+
+    def __repr__(self):
+        return f'RowsToColumns(rows={self._rows!r}, dtypes={self._dtypes!r})'
+
+    def dtypes(self):
+        return self._dtypes
+
+    def __iter__(self):
+        rows = iter(self._rows)
+        columns = None
+        while True:
+            values = self._batch_values(itertools.islice(rows, self._batchsize))
+            if values is None:
+                return
+            if columns is None:
+                columns = self._columns_for(values)
+            batch = [self._converted(index, columns, column) for index, column in enumerate(values)]
+            yield self._as_numpy(batch) if self._numpy else batch
+
+    def _batch_values(self, rows):
+        values = None
+        for piece in self._pieces(rows):
+            if values is None:
+                width = len(self._dtypes) if self._dtypes else max(map(len, piece))
+                values = [[] for _ in range(width)]
+            for column, part in zip(values, self._values(piece, len(values))):
+                column.extend(part)
+        return values
+
+    def _pieces(self, rows):
+        return iter(lambda: list(itertools.islice(rows, self._ROWS_PER_PIECE)), [])
+
+    def _columns_for(self, values):
+        self._given = self._given or [None] * len(values)
+        self._dtypes = [dtype or self._inferred_dtype(column) for dtype, column in zip(self._given, values)]
+        return [self._COLUMNS[dtype]() for dtype in self._dtypes]
+
+    def _converted(self, index, columns, values):
+        while True:
+            try:
+                return columns[index].convert(values)
+            except (ValueError, OverflowError):
+                if self._given[index] or self._dtypes[index] not in self._WIDER:
+                    raise
+                self._dtypes[index] = self._WIDER[self._dtypes[index]]
+                columns[index] = self._COLUMNS[self._dtypes[index]]()
+
+    def _inferred_dtype(self, values):
+        if not any(values):
+            return 'str'
+        for dtype in ('int', 'float'):
+            try:
+                self._COLUMNS[dtype]().convert(values)
+                return dtype
+            except (ValueError, OverflowError):
+                pass
+        return 'category' if len(set(values)) * 2 <= len(values) else 'str'
+
+    @staticmethod
+    def _values(piece, width):
+        if set(map(len, piece)) != {width}:
+            # short rows are padded with empty fields and long ones cut to width
+            piece = [list(row[:width]) + [''] * (width - len(row)) for row in piece]
+        return list(zip(*piece))
+
+    @staticmethod
+    def _as_numpy(batch):
+        import numpy
+        for column in batch:
+            if isinstance(column, Categorical):
+                column.codes = numpy.frombuffer(column.codes, dtype=column.codes.typecode)
+        return [
+            numpy.frombuffer(column, dtype=column.typecode) if isinstance(column, array) else column
+            for column in batch
+        ]
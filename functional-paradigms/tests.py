@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+from functional import file_to_rows
+
+
+EDGE_CASES = [
+    'a,b"c,d\ne,f,g\nh,"i\nj",k\nl,m,n\n',
+    'a,"b\nc\nd",e\nf,g\n',
+    'a,"b "" c",d\n"e\n""\nf",g\nh\n',
+    'a,"b\n\nc",d\ne,f\n',
+    'a,b\r\n"c\r\nd",e\r\nf,g\r\n',
+    'a,"b\nc,d\ne,f\n',
+    'a,b\nc,d',
+    '"a"b,c\nd,"e"\n',
+]
+
+
+def serial_rows(path):
+    return list(file_to_rows(str(path)))
+
+
+@pytest.mark.parametrize('content', EDGE_CASES)
+def test_ranges_parse_like_the_serial_parse(tmp_path, content):
+    path = tmp_path / 'edge.csv'
+    path.write_text(content, newline='')
+    expected = serial_rows(path)
+    for chunksize in range(1, len(content) + 2):
+        assert list(file_to_rows(str(path), processes=2, chunksize=chunksize)) == expected
+
+
+@pytest.mark.parametrize('extension', ['csv', 'psv', 'tsv'])
+def test_ranges_parse_random_files_like_the_serial_parse(tmp_path, extension):
+    rng = random.Random(extension)
+    path = tmp_path / f'random.{extension}'
+    pieces = ['a', 'b', '"', '""', '\n', '\r\n', ',', '|', '\t', ' ']
+    for _ in range(100):
+        content = ''.join(rng.choice(pieces) for _ in range(rng.randrange(40)))
+        path.write_text(content, newline='')
+        expected = serial_rows(path)
+        chunksize = rng.randrange(1, 12)
+        for ordered in (True, False):
+            rows = file_to_rows(str(path), processes=2, ordered=ordered, chunksize=chunksize)
+            assert list(rows) == expected, (content, chunksize)
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+
+# asyncio port of mincemeat.py
+#
+# Same programming model: set datasource, mapfn, reducefn (and optionally
+# collectfn) on a Server, call run_server, and point workers at it with
+# `python3 -m aiomincemeat -p <password> <server>`.  mincemeat.py depends on
+# asyncore/asynchat, which are gone as of Python 3.12; this module only needs
+# asyncio.
+#
+# Unlike mincemeat.py, a worker does not wait for the next task after it
+# reports back: it grants the server a window of credits and the server
+# keeps that many tasks in flight on the connection, so the next task is
+# already local when the current one finishes.  The two modules do not
+# speak the same wire protocol.
+
+import os
+import hmac
+import types
+import random
+import struct
+import asyncio
+import hashlib
+import logging
+import marshal
+import pickle
+import argparse
+import concurrent.futures
+
+
+VERSION = "0.1.4"
+
+
+DEFAULT_PORT = 11235
+
+DEFAULT_WINDOW = 4
+
+
+FRAME_HEADER = struct.Struct("!BQ")
+
+# Frames carry the index of the command in this tuple, so new commands must
+# only ever be appended.
+COMMANDS = (
+    'challenge', 'auth', 'disconnect', 'credit',
+    'mapfn', 'collectfn', 'reducefn',
+    'map', 'mapdone', 'reduce', 'reducedone',
+    )
+
+COMMAND_IDS = {command: i for i, command in enumerate(COMMANDS)}
+
+# Frames before authentication only carry challenges and MACs
+MAX_UNAUTHED_PAYLOAD = 1024
+
+
+class Protocol:
+    def __init__(self, reader, writer, password):
+        self.reader = reader
+        self.writer = writer
+        self.password = password.encode() if isinstance(password, str) else password
+        self.authed = False
+
+    async def read_frame(self):
+        header = await self.reader.readexactly(FRAME_HEADER.size)
+        command_id, length = FRAME_HEADER.unpack(header)
+        if command_id >= len(COMMANDS):
+            raise ConnectionError("Unknown command id received: %d" % command_id)
+        if not self.authed and length > MAX_UNAUTHED_PAYLOAD:
+            raise ConnectionError("Oversized frame from unauthed source")
+        payload = await self.reader.readexactly(length) if length else b''
+        logging.debug("-> %s:%d", COMMANDS[command_id], length)
+        return COMMANDS[command_id], payload
+
+    def write_frame(self, command, payload=b''):
+        logging.debug("<- %s:%d", command, len(payload))
+        self.writer.writelines((FRAME_HEADER.pack(COMMAND_IDS[command], len(payload)), payload))
+
+    async def receive_command(self):
+        command, payload = await self.read_frame()
+        return command, pickle.loads(payload) if payload else None
+
+    def send_command(self, command, data=None):
+        payload = pickle.dumps(data, pickle.HIGHEST_PROTOCOL) if data is not None else b''
+        self.write_frame(command, payload)
+
+    def mac(self, challenge):
+        return hmac.new(self.password, challenge, hashlib.sha1).digest()
+
+    async def expect(self, expected):
+        command, payload = await self.read_frame()
+        if command != expected:
+            raise ConnectionError("Expected %s but received %s" % (expected, command))
+        return payload
+
+    async def authenticate(self, challenge_first):
+        # Both ends prove they know the password: each sends a random
+        # challenge and checks the HMAC the other end sends back.  The end
+        # that challenges first only answers the other's challenge once its
+        # own has been answered, so it never signs anything for a peer that
+        # hasn't authenticated.
+        challenge = os.urandom(20)
+        if challenge_first:
+            self.write_frame('challenge', challenge)
+            peer_challenge = await self.expect('challenge')
+            self.verify(await self.expect('auth'), challenge)
+            self.write_frame('auth', self.mac(peer_challenge))
+        else:
+            peer_challenge = await self.expect('challenge')
+            self.write_frame('challenge', challenge)
+            self.write_frame('auth', self.mac(peer_challenge))
+            self.verify(await self.expect('auth'), challenge)
+        self.authed = True
+        logging.info("Authenticated other end")
+
+    def verify(self, response, challenge):
+        if not hmac.compare_digest(response, self.mac(challenge)):
+            raise ConnectionError("Authentication failed")
+
+    def close(self):
+        self.writer.close()
+
+
+class Client:
+    def __init__(self):
+        self.mapfn = self.reducefn = self.collectfn = None
+        self.password = ""
+        self.window = DEFAULT_WINDOW
+
+    def conn(self, server, port):
+        asyncio.run(self.run(server, port))
+
+    async def run(self, server, port):
+        reader, writer = await asyncio.open_connection(server, port)
+        protocol = Protocol(reader, writer, self.password)
+        try:
+            await protocol.authenticate(challenge_first=False)
+            protocol.send_command('credit', self.window)
+            await self.serve(protocol)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.info("Connection closed: %s", e)
+        finally:
+            protocol.close()
+
+    async def serve(self, protocol):
+        commands = {
+            'mapfn': self.set_mapfn,
+            'collectfn': self.set_collectfn,
+            'reducefn': self.set_reducefn,
+            }
+        tasks = asyncio.Queue()
+        worker = asyncio.ensure_future(self.work(protocol, tasks))
+        try:
+            while True:
+                command, data = await protocol.receive_command()
+                if command in commands:
+                    commands[command](data)
+                elif command in ('map', 'reduce'):
+                    tasks.put_nowait((command, data))
+                elif command == 'disconnect':
+                    break
+                else:
+                    raise ConnectionError("Unknown command received: %s" % command)
+        finally:
+            worker.cancel()
+
+    async def work(self, protocol, tasks):
+        # Tasks run one at a time on a separate thread so the connection
+        # keeps receiving (and unpickling) the prefetched ones meanwhile.
+        loop = asyncio.get_running_loop()
+        calls = {
+            'map': ('mapdone', self.call_mapfn),
+            'reduce': ('reducedone', self.call_reducefn),
+            }
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                while True:
+                    command, data = await tasks.get()
+                    done, call = calls[command]
+                    protocol.send_command(done, await loop.run_in_executor(executor, call, data))
+                    await protocol.writer.drain()
+            except Exception:
+                logging.exception("Task failed")
+                protocol.close()
+
+    def set_mapfn(self, mapfn):
+        self.mapfn = types.FunctionType(marshal.loads(mapfn), globals(), 'mapfn')
+
+    def set_collectfn(self, collectfn):
+        self.collectfn = types.FunctionType(marshal.loads(collectfn), globals(), 'collectfn')
+
+    def set_reducefn(self, reducefn):
+        self.reducefn = types.FunctionType(marshal.loads(reducefn), globals(), 'reducefn')
+
+    def call_mapfn(self, data):
+        logging.info("Mapping %s", data[0])
+        results = {}
+        for k, v in self.mapfn(data[0], data[1]):
+            if k not in results:
+                results[k] = []
+            results[k].append(v)
+        if self.collectfn:
+            for k in results:
+                results[k] = [self.collectfn(k, results[k])]
+        return (data[0], results)
+
+    def call_reducefn(self, data):
+        logging.info("Reducing %s", data[0])
+        return (data[0], self.reducefn(data[0], data[1]))
+
+
+class Server:
+    def __init__(self):
+        self.mapfn = None
+        self.reducefn = None
+        self.collectfn = None
+        self.datasource = None
+        self.password = None
+        self.channels = set()
+        self.finished = None
+
+    def run_server(self, password="", port=DEFAULT_PORT):
+        self.password = password
+        asyncio.run(self.serve(port))
+        return self.taskmanager.results
+
+    async def serve(self, port):
+        self.finished = asyncio.get_running_loop().create_future()
+        listener = await asyncio.start_server(self.handle_accept, port=port, reuse_address=True)
+        try:
+            await self.finished
+        finally:
+            listener.close()
+            for channel in list(self.channels):
+                channel.disconnect()
+            # Let each connection see its client hang up
+            await asyncio.gather(*[channel.task for channel in self.channels], return_exceptions=True)
+
+    async def handle_accept(self, reader, writer):
+        channel = ServerChannel(Protocol(reader, writer, self.password), self)
+        channel.task = asyncio.current_task()
+        self.channels.add(channel)
+        try:
+            await channel.run()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logging.info("Client disconnected: %s", e)
+        finally:
+            self.channels.discard(channel)
+            channel.protocol.close()
+
+    def wake(self):
+        # Completing a task can make new ones available (or finish a phase),
+        # so give every connection a chance to use its spare credits.
+        for channel in list(self.channels):
+            channel.fill()
+
+    def finish(self):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+    @property
+    def datasource(self):
+        return self._datasource
+
+    @datasource.setter
+    def datasource(self, ds):
+        self._datasource = ds
+        self.taskmanager = TaskManager(self._datasource, self)
+
+
+class ServerChannel:
+    def __init__(self, protocol, server):
+        self.protocol = protocol
+        self.server = server
+        self.credits = 0
+        self.tasks = set()
+        self.ready = False
+        self.task = None
+
+    async def run(self):
+        await self.protocol.authenticate(challenge_first=True)
+        self.post_auth_init()
+        commands = {
+            'credit': self.add_credit,
+            'mapdone': self.map_done,
+            'reducedone': self.reduce_done,
+            }
+        while True:
+            command, data = await self.protocol.receive_command()
+            if command not in commands:
+                raise ConnectionError("Unknown command received: %s" % command)
+            commands[command](data)
+
+    def post_auth_init(self):
+        if self.server.mapfn:
+            self.protocol.send_command('mapfn', marshal.dumps(self.server.mapfn.__code__))
+        if self.server.reducefn:
+            self.protocol.send_command('reducefn', marshal.dumps(self.server.reducefn.__code__))
+        if self.server.collectfn:
+            self.protocol.send_command('collectfn', marshal.dumps(self.server.collectfn.__code__))
+        self.ready = True
+
+    def add_credit(self, data):
+        self.credits += data
+        self.fill()
+
+    def fill(self):
+        while self.ready and self.credits > 0:
+            task = self.server.taskmanager.next_task(self)
+            if task is None:
+                return
+            command, data = task
+            if command == 'disconnect':
+                self.disconnect()
+                return
+            self.tasks.add((command, data[0]))
+            self.credits -= 1
+            self.protocol.send_command(command, data)
+
+    def disconnect(self):
+        # The client hangs up on receiving this, which ends run()
+        if self.ready:
+            self.ready = False
+            self.protocol.send_command('disconnect')
+
+    def map_done(self, data):
+        self.tasks.discard(('map', data[0]))
+        self.credits += 1
+        self.server.taskmanager.map_done(data)
+        self.server.wake()
+
+    def reduce_done(self, data):
+        self.tasks.discard(('reduce', data[0]))
+        self.credits += 1
+        self.server.taskmanager.reduce_done(data)
+        self.server.wake()
+
+
+class TaskManager:
+    START = 0
+    MAPPING = 1
+    REDUCING = 2
+    FINISHED = 3
+
+    def __init__(self, datasource, server):
+        self.datasource = datasource
+        self.server = server
+        self.state = TaskManager.START
+
+    def next_task(self, channel):
+        if self.state == TaskManager.START:
+            self.map_iter = iter(self.datasource)
+            self.working_maps = {}
+            self.map_results = {}
+            self.state = TaskManager.MAPPING
+        if self.state == TaskManager.MAPPING:
+            try:
+                map_key = next(self.map_iter)
+                map_item = map_key, self.datasource[map_key]
+                self.working_maps[map_item[0]] = map_item[1]
+                return ('map', map_item)
+            except StopIteration:
+                if len(self.working_maps) > 0:
+                    return self.duplicate(channel, 'map', self.working_maps)
+                self.state = TaskManager.REDUCING
+                self.reduce_iter = iter(self.map_results.items())
+                self.working_reduces = {}
+                self.results = {}
+        if self.state == TaskManager.REDUCING:
+            try:
+                reduce_item = next(self.reduce_iter)
+                self.working_reduces[reduce_item[0]] = reduce_item[1]
+                return ('reduce', reduce_item)
+            except StopIteration:
+                if len(self.working_reduces) > 0:
+                    return self.duplicate(channel, 'reduce', self.working_reduces)
+                self.state = TaskManager.FINISHED
+        if self.state == TaskManager.FINISHED:
+            self.server.finish()
+            return ('disconnect', None)
+
+    def duplicate(self, channel, command, working):
+        # Hand an idle window a copy of some other connection's task, never
+        # one this connection is already working on.
+        keys = [key for key in working if (command, key) not in channel.tasks]
+        if not keys:
+            return None
+        key = random.choice(keys)
+        return (command, (key, working[key]))
+
+    def map_done(self, data):
+        # Don't use the results if they've already been counted
+        if data[0] not in self.working_maps:
+            return
+
+        for (key, values) in data[1].items():
+            if key not in self.map_results:
+                self.map_results[key] = []
+            self.map_results[key].extend(values)
+        del self.working_maps[data[0]]
+
+    def reduce_done(self, data):
+        # Don't use the results if they've already been counted
+        if data[0] not in self.working_reduces:
+            return
+
+        self.results[data[0]] = data[1]
+        del self.working_reduces[data[0]]
+
+
+def run_client():
+    parser = argparse.ArgumentParser(usage="%(prog)s [options] server_name")
+    parser.add_argument("-p", "--password", dest="password", default="", help="password")
+    parser.add_argument("-P", "--port", dest="port", type=int, default=DEFAULT_PORT, help="port")
+    parser.add_argument("-w", "--window", dest="window", type=int, default=DEFAULT_WINDOW,
+                        help="number of tasks to keep in flight")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true")
+    parser.add_argument("-V", "--loud", dest="loud", action="store_true")
+    parser.add_argument("--version", action="version", version="%(prog)s {0}".format(VERSION))
+    parser.add_argument("server_name", default="localhost", nargs="?", help="server name")
+
+    options = parser.parse_args()
+
+    if options.verbose:
+        logging.basicConfig(level=logging.INFO)
+    if options.loud:
+        logging.basicConfig(level=logging.DEBUG)
+
+    client = Client()
+    client.password = options.password
+    client.window = max(1, options.window)
+    client.conn(options.server_name, options.port)
+
+
+if __name__ == '__main__':
+    run_client()
@@ -0,0 +1,172 @@
+"""Benchmarks for mincemeat on loopback.
+
+Each case runs a canned job on a local Server with N clients connected over
+loopback, in a coordinator process of its own so that its peak RSS is its
+own.  Results for every case go to a JSON file, so runs before and after a
+change can be compared:
+
+    python bench.py --workers 1,2,4 --sizes 1,4 --output before.json
+    python bench.py --workers 1 --batchsize 100 --clientargs "-w 4"
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import time
+
+import mincemeat
+import pi
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MOVIES = os.path.join(HERE, '..', 'map-filter-reduce', 'movie_metadata.csv')
+
+log = logging.getLogger()
+
+
+def pi_job(size):
+    return pi.get_data(mapsize=20000 * size, nummaps=100), pi.mapfn, pi.reducefn, None
+
+
+def wordcount_mapfn(key, value):
+    for word in value.lower().replace(',', ' ').replace('|', ' ').split():
+        yield word, 1
+
+
+def wordcount_collectfn(key, value):
+    return sum(value)
+
+
+def wordcount_reducefn(key, value):
+    return sum(value)
+
+
+def wordcount_job(size):
+    # size scales the number of lines per task
+    with open(MOVIES) as f:
+        lines = f.readlines()
+    chunk = 50 * size
+    data = dict((i // chunk, ''.join(lines[i:i + chunk])) for i in range(0, len(lines), chunk))
+    return data, wordcount_mapfn, wordcount_reducefn, wordcount_collectfn
+
+
+def shuffle_mapfn(key, value):
+    # value is the number of records; every map writes to the same keys
+    payload = 'x' * 100
+    for i in xrange(value):
+        yield 'k%d' % (i % 10000), payload
+
+
+def shuffle_reducefn(key, value):
+    return len(value)
+
+
+def shuffle_job(size):
+    return dict((i, 2000 * size) for i in range(50)), shuffle_mapfn, shuffle_reducefn, None
+
+
+JOBS = {
+    'pi': pi_job,
+    'wordcount': wordcount_job,
+    'shuffle': shuffle_job,
+    }
+
+
+def run_case(job, workers, size, port, batchsize=1, clientargs=()):
+    datasource, mapfn, reducefn, collectfn = JOBS[job](size)
+    server = mincemeat.Server()
+    server.batchsize = batchsize
+    server.datasource = datasource
+    server.mapfn = mapfn
+    server.reducefn = reducefn
+    server.collectfn = collectfn
+
+    command = [sys.executable, os.path.join(HERE, 'mincemeat.py'), '-p', 'bench', '-P', str(port)]
+    # The first step of the server binds and listens, so no client started
+    # after it is refused
+    steps = server.serve('bench', port, False)
+    next(steps)
+    with open(os.devnull, 'w') as devnull:
+        clients = [subprocess.Popen(command + list(clientargs) + ['localhost'], stdout=devnull)
+                   for i in range(workers)]
+        started = time.time()
+        for _ in steps:
+            pass
+        elapsed = time.time() - started
+        for client in clients:
+            client.wait()
+
+    stats = server.get_stats()
+    phases = stats['phases_started_at']
+    commands = stats['commands'].values()
+    return {
+        'job': job,
+        'workers': workers,
+        'size': size,
+        'batchsize': batchsize,
+        'seconds': elapsed,
+        'maps': len(datasource),
+        'maps_per_second': len(datasource) / elapsed,
+        'phase_seconds': {
+            'map': phases['reduce'] - phases['map'],
+            'reduce': phases['finished'] - phases['reduce'],
+            },
+        'bytes_sent': sum(counts['sent_bytes'] for counts in commands),
+        'bytes_received': sum(counts['received_bytes'] for counts in commands),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stats': stats,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', default=','.join(sorted(JOBS)), help='comma separated jobs to run')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated client counts')
+    parser.add_argument('--sizes', default='1,4', help='comma separated payload size multipliers')
+    parser.add_argument('--batchsize', type=int, default=1, help='keys per task message')
+    parser.add_argument('--port', type=int, default=mincemeat.DEFAULT_PORT)
+    parser.add_argument('--output', default='bench.json', help='file to write results to')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--clientargs', default='', help='extra arguments for every client, e.g. "-w 4"')
+    options = parser.parse_args()
+
+    if options.case:
+        log.setLevel(logging.WARNING)
+        job, workers, size = options.case.split(',')
+        result = run_case(job, int(workers), int(size), options.port, options.batchsize,
+                          shlex.split(options.clientargs))
+        json.dump(result, sys.stdout)
+        return
+
+    results = []
+    for job in options.jobs.split(','):
+        for workers in options.workers.split(','):
+            for size in options.sizes.split(','):
+                case = ','.join([job, workers, size])
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), '--case', case, '--port', str(options.port),
+                     '--batchsize', str(options.batchsize), '--clientargs', options.clientargs])
+                result = json.loads(output)
+                log.info('%s: %d workers, size %s: %.2fs, %.1f maps/s, %d bytes, %d KB peak RSS',
+                         job, result['workers'], size, result['seconds'], result['maps_per_second'],
+                         result['bytes_sent'] + result['bytes_received'], result['peak_rss_kb'])
+                results.append(result)
+
+    with open(options.output, 'w') as f:
+        json.dump({
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'version': mincemeat.VERSION,
+            'argv': sys.argv[1:],
+            'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.INFO)
+    main()
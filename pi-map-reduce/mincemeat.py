@@ -26,17 +26,40 @@
 
 import os
 import sys
+import bz2
 import hmac
+import heapq
+import errno
+import struct
+import time
+import zlib
 import types
-import random
+import select
 import socket
+import itertools
+import collections
+import json
 import hashlib
 import marshal
+import tempfile
+import multiprocessing
 import logging
 import argparse
+import math
+import threading
 import asynchat
 import asyncore
 import cPickle as pickle
+from cStringIO import StringIO
+from Queue import Queue, Empty
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 VERSION = "0.1.4"
@@ -45,6 +68,69 @@ VERSION = "0.1.4"
 DEFAULT_PORT = 11235
 
 
+# Wire formats a connection can use once both ends have authenticated, in
+# order of preference.  "text" is the original "command:length\n" protocol,
+# "binary" frames every message with FRAME_HEADER (command id, payload length).
+FRAMINGS = ('binary', 'text')
+
+FRAME_HEADER = struct.Struct("!BBQ")
+
+# Frame flag: the payload is compressed with the connection's codec
+FRAME_COMPRESSED = 1
+
+# Binary frames carry the index of the command in this tuple, so new
+# commands must only ever be appended.
+COMMANDS = (
+    'challenge', 'auth', 'disconnect',
+    'mapfn', 'collectfn', 'reducefn',
+    'map', 'mapbatch', 'mapdone', 'mapbatchdone',
+    'reduce', 'reducebatch', 'reducedone', 'reducebatchdone',
+    'partial', 'partialdone',
+    'cancel', 'cancelled',
+    'function',
+    'mappartial',
+    'heartbeat',
+    )
+
+COMMAND_IDS = dict((command, i) for i, command in enumerate(COMMANDS))
+
+# Payloads are queued for sending in slices of this size
+FRAME_SEND_SIZE = 65536
+
+# Payload compressors by name, as (compress(data, level), decompress(data),
+# default level).  Binary-framed connections can negotiate one of these
+# during the handshake, written as "name" or "name-level" (e.g. "zlib-1").
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress, 6),
+    'bz2': (bz2.compress, bz2.decompress, 9),
+    }
+if lzma:
+    CODECS['lzma'] = (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6)
+
+# Payloads smaller than this many bytes are never worth compressing
+COMPRESS_MIN = 4096
+
+# Optional behaviour a client tells the server it understands, so that
+# older clients are never sent commands they would hang up on
+FEATURES = ('cancel', 'fncache', 'mappartial', 'heartbeat', 'partial')
+
+# Replies that end a task, i.e. after which a worker is free again
+TASK_REPLIES = ('mapdone', 'mapbatchdone', 'reducedone', 'reducebatchdone', 'partialdone', 'cancelled')
+
+# Values a key collects within one map before collectfn is applied to them,
+# and the rough number of bytes of output a map buffers before sending what
+# it has so far as a 'mappartial' (clients can override both)
+COMBINE_SIZE = 1000
+MAP_BUDGET = 64 * 1024 * 1024
+
+# Seconds between the server's housekeeping passes, and between a client's
+# checks for cancelled tasks while it is busy mapping
+TICK_INTERVAL = 1.0
+
+# Seconds between the heartbeats a client sends while it is running a task
+HEARTBEAT_INTERVAL = 5.0
+
+
 class Protocol(asynchat.async_chat):
     def __init__(self, conn=None, map=None):
         if conn:
@@ -56,61 +142,282 @@ class Protocol(asynchat.async_chat):
         self.buffer = []
         self.auth = None
         self.mid_command = False
+        self.framings = FRAMINGS
+        self.framing = 'text'
+        self.pending_framing = 'text'
+        self.responded = False
+        self.peer_features = set()
+        # Processes the other end runs tasks on; a client with more than
+        # one is sent batches big enough to keep them all busy
+        self.workers = 1
+        self.peer_workers = 1
+        # Relative speed of one of those processes (see benchmark)
+        self.score = None
+        self.peer_score = None
+        self.compression = ()
+        self.compressmin = COMPRESS_MIN
+        self.codec = None
+        self.stats = None
+        self.frame_command = None
+        self.reset_frame(bytearray(FRAME_HEADER.size))
 
     def collect_incoming_data(self, data):
-        self.buffer.append(data)
+        if self.framing == 'binary':
+            self.feed_frame(data)
+        else:
+            self.buffer.append(data)
 
     def send_command(self, command, data=None):
+        if self.framing == 'binary':
+            self.send_frame(command, data)
+            return
+        name = command.split(":", 1)[0]
         if not ":" in command:
             command += ":"
         if data:
+            started = time.time()
             pdata = pickle.dumps(data)
+            if self.stats:
+                self.stats.sent(name, len(command) + len(str(len(pdata))) + 1 + len(pdata), time.time() - started)
             command += str(len(pdata))
             logging.debug( "<- %s" % command)
             self.push(command + "\n" + pdata)
         else:
+            if self.stats:
+                self.stats.sent(name, len(command) + 1)
             logging.debug( "<- %s" % command)
             self.push(command + "\n")
 
+    def send_frame(self, command, data=None):
+        started = time.time()
+        if data is not None:
+            pdata = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        else:
+            pdata = ''
+        pickle_seconds = time.time() - started
+        flags = 0
+        if self.codec and len(pdata) >= self.compressmin:
+            started = time.time()
+            name, level = parse_codec(self.codec)
+            compressed = CODECS[name][0](pdata, level)
+            if self.stats:
+                self.stats.compressed(command, len(pdata), len(compressed), time.time() - started)
+            # Incompressible payloads go out as they are
+            if len(compressed) < len(pdata):
+                pdata = compressed
+                flags |= FRAME_COMPRESSED
+        # Bytes on the wire, so counted after any compression
+        if self.stats:
+            self.stats.sent(command, FRAME_HEADER.size + len(pdata), pickle_seconds)
+        logging.debug("<- %s:%d" % (command, len(pdata)))
+        header = FRAME_HEADER.pack(COMMAND_IDS[command], flags, len(pdata))
+        if len(pdata) < FRAME_SEND_SIZE:
+            self.producer_fifo.append(header + pdata)
+        else:
+            # Queue the header and slices of the pickle separately instead of
+            # concatenating them into yet another copy of the payload.
+            self.producer_fifo.append(header)
+            for offset in xrange(0, len(pdata), FRAME_SEND_SIZE):
+                self.producer_fifo.append(buffer(pdata, offset, FRAME_SEND_SIZE))
+        self.initiate_send()
+
     def found_terminator(self):
         if not self.auth == "Done":
             command, data = (''.join(self.buffer).split(":",1))
             self.process_unauthed_command(command, data)
         elif not self.mid_command:
             logging.debug("-> %s" % ''.join(self.buffer))
-            command, length = (''.join(self.buffer)).split(":", 1)
+            header = ''.join(self.buffer)
+            command, length = header.split(":", 1)
             if command == "challenge":
                 self.process_command(command, length)
             elif length:
                 self.set_terminator(int(length))
                 self.mid_command = command
+                self.mid_header_bytes = len(header) + 1
             else:
+                if self.stats:
+                    self.stats.received(command, len(header) + 1)
                 self.process_command(command)
         else: # Read the data segment from the previous command
             if not self.auth == "Done":
                 logging.fatal("Recieved pickled data from unauthed source")
                 sys.exit(1)
-            data = pickle.loads(''.join(self.buffer))
+            started = time.time()
+            payload = ''.join(self.buffer)
+            data = pickle.loads(payload)
+            if self.stats:
+                self.stats.received(self.mid_command, self.mid_header_bytes + len(payload), time.time() - started)
             self.set_terminator("\n")
             command = self.mid_command
             self.mid_command = None
             self.process_command(command, data)
         self.buffer = []
 
-    def send_challenge(self):
+    def handle_read(self):
+        if self.framing != 'binary':
+            asynchat.async_chat.handle_read(self)
+            return
+
+        try:
+            received = self.socket.recv_into(self.frame_view[self.frame_pos:])
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
+            raise
+        if not received:
+            self.handle_close()
+            return
+        self.frame_pos += received
+        if self.frame_pos == len(self.frame_view):
+            self.frame_complete()
+
+    def feed_frame(self, data):
+        # Bytes that arrived in the same read as the end of the handshake
+        offset = 0
+        while offset < len(data):
+            count = min(len(data) - offset, len(self.frame_view) - self.frame_pos)
+            self.frame_view[self.frame_pos:self.frame_pos + count] = data[offset:offset + count]
+            self.frame_pos += count
+            offset += count
+            if self.frame_pos == len(self.frame_view):
+                self.frame_complete()
+
+    def reset_frame(self, frame_buffer):
+        self.frame_buffer = frame_buffer
+        self.frame_view = memoryview(frame_buffer)
+        self.frame_pos = 0
+
+    def frame_complete(self):
+        command = self.frame_command
+        if command is None:
+            command_id, self.frame_flags, length = FRAME_HEADER.unpack_from(self.frame_buffer)
+            command = COMMANDS[command_id]
+            logging.debug("-> %s:%d" % (command, length))
+            if length:
+                self.frame_command = command
+                self.reset_frame(bytearray(length))
+                return
+            data = None
+            if self.stats:
+                self.stats.received(command, FRAME_HEADER.size)
+        else:
+            payload = buffer(self.frame_buffer)
+            if self.frame_flags & FRAME_COMPRESSED:
+                started = time.time()
+                payload = CODECS[parse_codec(self.codec)[0]][1](payload)
+                if self.stats:
+                    self.stats.decompressed(command, len(self.frame_buffer), len(payload), time.time() - started)
+            started = time.time()
+            data = pickle.load(StringIO(payload))
+            if self.stats:
+                self.stats.received(command, FRAME_HEADER.size + len(self.frame_buffer), time.time() - started)
+        self.frame_command = None
+        self.reset_frame(bytearray(FRAME_HEADER.size))
+        self.process_command(command, data)
+
+    def switch_framing(self):
+        # Both ends switch once they have authenticated each other and have
+        # answered each other's challenge: everything after that is framed.
+        if self.auth != "Done" or not self.responded or self.framing == self.pending_framing:
+            return
+        logging.debug("Switching to %s framing" % self.pending_framing)
+        self.framing = self.pending_framing
+        if self.framing != 'binary':
+            # Compressed payloads are marked by a frame flag, so text
+            # framing always sends them as they are
+            self.codec = None
+        if self.framing == 'binary':
+            logging.debug("Compressing payloads with %s" % self.codec)
+            self.set_terminator(None)
+            self.ac_out_buffer_size = FRAME_SEND_SIZE
+            # Large frames go out as several writes; don't let Nagle hold
+            # back the tail of a frame waiting for the peer's ACK.
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handshake_options(self):
+        # Only the server's challenge lists its features; a client lists its
+        # own in its reply, and only to a server that listed some
+        options = {'framing': ",".join(self.framings), 'features': ",".join(FEATURES)}
+        if self.compression:
+            options['codec'] = ",".join(self.compression)
+            options['compressmin'] = str(self.compressmin)
+        return options
+
+    def accepts_codec(self, spec):
+        name = parse_codec(spec)[0]
+        return name in CODECS and (spec in self.compression or name in self.compression)
+
+    def parse_options(self, data):
+        parts = data.split(" ")
+        options = {}
+        for part in parts[1:]:
+            name, value = part.split("=", 1)
+            options[name] = value.split(",")
+        return parts[0], options
+
+    def choose_options(self, options):
+        chosen = {}
+        if 'features' in options:
+            chosen['features'] = list(FEATURES)
+            if self.workers > 1:
+                chosen['workers'] = [str(self.workers)]
+            if self.score:
+                chosen['score'] = [str(int(self.score))]
+        for framing in self.framings:
+            if framing in options.get('framing', ()):
+                chosen['framing'] = [framing]
+                break
+        # The server lists codecs in its order of preference
+        for spec in options.get('codec', ()):
+            if self.accepts_codec(spec):
+                chosen['codec'] = [spec]
+                chosen['compressmin'] = options.get('compressmin', [str(COMPRESS_MIN)])
+                break
+        return chosen
+
+    def apply_options(self, options):
+        if 'framing' in options and options['framing'][0] in self.framings:
+            self.pending_framing = options['framing'][0]
+        if 'codec' in options and self.accepts_codec(options['codec'][0]):
+            self.codec = options['codec'][0]
+            self.compressmin = int(options.get('compressmin', [COMPRESS_MIN])[0])
+
+    def send_challenge(self, options=None):
         self.auth = os.urandom(20).encode("hex")
+        if options:
+            self.auth += "".join(" %s=%s" % (name, options[name]) for name in sorted(options))
         self.send_command(":".join(["challenge", self.auth]))
 
     def respond_to_challenge(self, command, data):
         mac = hmac.new(self.password, data, hashlib.sha1)
-        self.send_command(":".join(["auth", mac.digest().encode("hex")]))
+        response = mac.digest().encode("hex")
+        options = self.parse_options(data)[1]
+        self.peer_features.update(options.get('features', ()))
+        chosen = self.choose_options(options)
+        if chosen:
+            self.apply_options(chosen)
+            response += "".join(" %s=%s" % (name, ",".join(chosen[name])) for name in sorted(chosen))
+        self.send_command(":".join(["auth", response]))
+        self.responded = True
+        self.switch_framing()
         self.post_auth_init()
 
     def verify_auth(self, command, data):
         mac = hmac.new(self.password, self.auth, hashlib.sha1)
-        if data == mac.digest().encode("hex"):
+        response, options = self.parse_options(data)
+        if response == mac.digest().encode("hex"):
             self.auth = "Done"
+            self.apply_options(options)
+            self.peer_features.update(options.get('features', ()))
+            self.peer_workers = max(1, int(options.get('workers', [1])[0]))
+            if 'score' in options:
+                self.peer_score = max(1, int(options['score'][0]))
             logging.info("Authenticated other end")
+            self.switch_framing()
         else:
             self.handle_close()
 
@@ -140,58 +447,237 @@ class Protocol(asynchat.async_chat):
             self.handle_close()
 
 
+class TaskCancelled(Exception):
+    pass
+
+
 class Client(Protocol):
     def __init__(self):
         Protocol.__init__(self)
         self.mapfn = self.reducefn = self.collectfn = None
+        self.cancelled = set()
+        self.compression = tuple(CODECS)
+        self.functions = {}
+        self.combinesize = COMBINE_SIZE
+        self.mapbudget = MAP_BUDGET
+        self.codes = {}
+        self.pool = None
+        self.pool_codes = None
+        self.busy = False
+        # Held by anything writing to the socket, since the heartbeat
+        # thread writes while the main thread is busy with a task
+        self.send_lock = threading.RLock()
 
     def conn(self, server, port):
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((server, port))
+        heartbeat = threading.Thread(target=self.send_heartbeats, name="heartbeat")
+        heartbeat.daemon = True
+        heartbeat.start()
         asyncore.loop()
 
+    def send_heartbeats(self):
+        # A task can run for a long time without returning control to the
+        # event loop, so heartbeats come from a thread of their own
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            if self.busy and self.connected and 'heartbeat' in self.peer_features:
+                self.send_command('heartbeat')
+
+    def send_command(self, command, data=None):
+        with self.send_lock:
+            Protocol.send_command(self, command, data)
+
+    def initiate_send(self):
+        with self.send_lock:
+            Protocol.initiate_send(self)
+
     def handle_connect(self):
         pass
 
     def handle_close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
         self.close()
 
+    def set_code(self, name, code):
+        self.codes[name] = code
+        setattr(self, name, types.FunctionType(marshal.loads(code), globals(), name))
+
     def set_mapfn(self, command, mapfn):
-        self.mapfn = types.FunctionType(marshal.loads(mapfn), globals(), 'mapfn')
+        self.set_code('mapfn', mapfn)
 
     def set_collectfn(self, command, collectfn):
-        self.collectfn = types.FunctionType(marshal.loads(collectfn), globals(), 'collectfn')
+        self.set_code('collectfn', collectfn)
 
     def set_reducefn(self, command, reducefn):
-        self.reducefn = types.FunctionType(marshal.loads(reducefn), globals(), 'reducefn')
+        self.set_code('reducefn', reducefn)
+
+    def set_function(self, command, data):
+        # Functions are known by a digest of their code, which is only sent
+        # the first time; later jobs using the same function just name it.
+        name, digest, code = data
+        if digest is None:
+            self.codes.pop(name, None)
+            setattr(self, name, None)
+            return
+        if code is not None:
+            self.functions[digest] = code
+        self.set_code(name, self.functions[digest])
 
     def call_mapfn(self, command, data):
+        self.cancelled.clear()
+        if command == 'mapbatch' and self.workers > 1:
+            logging.info("Mapping batch of %d on %d workers" % (len(data), self.workers))
+            self.send_results('map', 'mapbatchdone', data, self.pool_map(_local_map, 'map', data))
+        elif command == 'mapbatch':
+            logging.info("Mapping batch of %d" % len(data))
+            results = []
+            for item in data:
+                self.poll_cancellations()
+                try:
+                    results.append(self.map_item(item))
+                except TaskCancelled:
+                    pass
+            self.send_results('map', 'mapbatchdone', data, results)
+        else:
+            try:
+                self.send_command('mapdone', self.map_item(data))
+            except TaskCancelled:
+                self.send_command('cancelled', [('map', data[0])])
+
+    def send_results(self, phase, command, data, results):
+        if results:
+            self.send_command(command, results)
+        else:
+            self.send_command('cancelled', [(phase, item[0]) for item in data])
+
+    def map_item(self, data):
+        if ('map', data[0]) in self.cancelled:
+            raise TaskCancelled()
         logging.info("Mapping %s" % str(data[0]))
+        # Raw values per key, and what collectfn has already made of earlier
+        # ones.  A key can end up with several collected values, which the
+        # reducefn sees just as if they had come from different maps.
         results = {}
+        collected = {}
+        buffered = 0
+        flush = self.mapbudget and 'mappartial' in self.peer_features
+        checked = time.time()
         for k, v in self.mapfn(data[0], data[1]):
             if k not in results:
                 results[k] = []
-            results[k].append(v)
-        if self.collectfn:
-            for k in results:
-                results[k] = [self.collectfn(k, results[k])]
-        self.send_command('mapdone', (data[0], results))
+            values = results[k]
+            values.append(v)
+            if flush:
+                buffered += sys.getsizeof(v)
+            if self.collectfn and self.combinesize and len(values) >= self.combinesize:
+                value = self.collectfn(k, values)
+                collected.setdefault(k, []).append(value)
+                results[k] = []
+                if flush:
+                    buffered += sys.getsizeof(value) - sum(sys.getsizeof(item) for item in values)
+            if flush and buffered > self.mapbudget:
+                logging.debug("Sending partial output of %s" % str(data[0]))
+                self.send_command('mappartial', (data[0], self.map_output(results, collected)))
+                results = {}
+                collected = {}
+                buffered = 0
+            if time.time() - checked > TICK_INTERVAL:
+                checked = time.time()
+                self.poll_cancellations()
+                if ('map', data[0]) in self.cancelled:
+                    logging.info("Cancelled %s" % str(data[0]))
+                    raise TaskCancelled()
+        return (data[0], self.map_output(results, collected))
+
+    def map_output(self, results, collected):
+        if not self.collectfn:
+            return results
+        for k, values in results.iteritems():
+            if values:
+                collected.setdefault(k, []).append(self.collectfn(k, values))
+        return collected
 
     def call_reducefn(self, command, data):
+        self.cancelled.clear()
+        if command == 'reducebatch' and self.workers > 1:
+            logging.info("Reducing batch of %d on %d workers" % (len(data), self.workers))
+            self.send_results('reduce', 'reducebatchdone', data, self.pool_map(_local_reduce, 'reduce', data))
+        elif command == 'reducebatch':
+            logging.info("Reducing batch of %d" % len(data))
+            results = []
+            for item in data:
+                self.poll_cancellations()
+                if ('reduce', item[0]) not in self.cancelled:
+                    results.append(self.reduce_item(item))
+            self.send_results('reduce', 'reducebatchdone', data, results)
+        else:
+            self.send_command('reducedone', self.reduce_item(data))
+
+    def pool_map(self, fn, phase, items):
+        # The pool's processes are started afresh whenever the job's
+        # functions change, since they can only be handed over at startup
+        codes = tuple(self.codes.get(name) for name in ('mapfn', 'reducefn', 'collectfn'))
+        if self.pool is None or self.pool_codes != codes:
+            if self.pool:
+                self.pool.terminate()
+            self.pool = multiprocessing.Pool(self.workers, _local_init, codes + (self.combinesize,))
+            self.pool_codes = codes
+        # Tasks cancelled while the pool works on them still run to the end,
+        # but their results are dropped
+        results = []
+        for result in self.pool.imap_unordered(fn, items):
+            self.poll_cancellations()
+            results.append(result)
+        return [result for result in results if (phase, result[0]) not in self.cancelled]
+
+    def poll_cancellations(self):
+        # Tasks run inline, so while busy the only way to hear about a
+        # 'cancel' is to handle whatever the server has sent in the meantime
+        if 'cancel' not in self.peer_features or not self.connected:
+            return
+        if select.select([self.socket], [], [], 0)[0]:
+            self.handle_read()
+
+    def cancel_tasks(self, command, data):
+        self.cancelled.update(data)
+
+    def call_partialfn(self, command, data):
+        logging.info("Partially reducing %d keys" % len(data[1]))
+        if self.workers > 1:
+            results = self.pool_map(_local_reduce, 'partial', data[1])
+        else:
+            results = [self.reduce_item(item) for item in data[1]]
+        self.send_command('partialdone', (data[0], results))
+
+    def reduce_item(self, data):
         logging.info("Reducing %s" % str(data[0]))
         results = self.reducefn(data[0], data[1])
-        self.send_command('reducedone', (data[0], results))
+        return (data[0], results)
 
     def process_command(self, command, data=None):
         commands = {
             'mapfn': self.set_mapfn,
             'collectfn': self.set_collectfn,
             'reducefn': self.set_reducefn,
+            'function': self.set_function,
             'map': self.call_mapfn,
+            'mapbatch': self.call_mapfn,
             'reduce': self.call_reducefn,
+            'reducebatch': self.call_reducefn,
+            'partial': self.call_partialfn,
+            'cancel': self.cancel_tasks,
             }
 
-        if command in commands:
+        if command in commands and command in ('map', 'mapbatch', 'reduce', 'reducebatch', 'partial'):
+            self.busy = True
+            try:
+                commands[command](command, data)
+            finally:
+                self.busy = False
+        elif command in commands:
             commands[command](command, data)
         else:
             Protocol.process_command(self, command, data)
@@ -210,20 +696,244 @@ class Server(asyncore.dispatcher, object):
         self.collectfn = None
         self.datasource = None
         self.password = None
+        # Maximum number of keys packed into one task message.  Anything
+        # above 1 switches to the 'mapbatch'/'reducebatch' commands.
+        self.batchsize = 1
+        # Target number of seconds per batch.  When set, each worker's batch
+        # size adapts (up to batchsize) to how long its recent batches took.
+        self.batchtime = None
+        # Wire formats offered to clients during the handshake
+        self.framings = FRAMINGS
+        # Codecs offered to clients for compressing binary-framed payloads
+        # of at least compressmin bytes, most preferred first, e.g.
+        # ('zlib-1', 'bz2-9').  Empty leaves payloads uncompressed.
+        self.compression = ()
+        self.compressmin = COMPRESS_MIN
+        # Rough number of bytes of intermediate map output kept in memory
+        # before it is spilled to disk in sorted runs (None never spills),
+        # and the directory the runs go to (None uses the system default).
+        self.shufflebudget = None
+        self.shuffledir = None
+        # Number of hash buckets to reduce into while maps are still running
+        # (None waits for every map).  Only for reducefns whose result can be
+        # fed back into them as a value, such as sums, and then reduced again.
+        self.partitions = None
+        # Values a bucket has to collect before a partial reduce of it is
+        # scheduled
+        self.partialsize = 1000
+        # Called with the results of reducing the output of the maps
+        # finished so far, each time another one finishes.  Once it returns
+        # true the remaining maps are cancelled and those results returned.
+        # Also only for reducefns whose result can be fed back into them.
+        self.convergencefn = None
+        # Once there is nothing new to hand out, an idle worker only gets a
+        # copy of a running task if that task has been running longer than
+        # speculatefactor times the speculatepercentile of completed task
+        # times (measured once speculatemin tasks have finished), and only
+        # while it has fewer than speculatecopies extra copies running.
+        self.speculatepercentile = 0.9
+        self.speculatefactor = 1.5
+        self.speculatemin = 5
+        self.speculatecopies = 1
+        # Most map tasks handed out and not yet finished at any one time.
+        # Their inputs are kept for re-dispatch, so with a streaming
+        # datasource this bounds how much of it is held in memory.
+        self.inflight = 10000
+        # Seconds a worker holding tasks can go unheard from before it is
+        # dropped and its tasks handed out again (None waits forever).
+        # Only applies to clients that send heartbeats.
+        self.heartbeattimeout = 6 * HEARTBEAT_INTERVAL
+        # Each (key, result) is passed to resultfn and written to resultsink
+        # (e.g. a ShardedSink) as soon as it is reduced.  Turn keepresults
+        # off to stop them also piling up in the dict run_server returns.
+        self.resultfn = None
+        self.resultsink = None
+        self.keepresults = True
+        self.delivered = None
+        # Counters for the running job (see get_stats), optionally written
+        # as JSON to statsfile every statsinterval seconds
+        self.stats = Stats()
+        self.statsfile = None
+        self.statsinterval = 10
+        self.stats_dumped = time.time()
+        # Directory to log completed map and reduce results to, so that a
+        # job can be resumed after the server dies (see run_server).  A log
+        # is only resumed by the same functions over the same datasource: a
+        # mapping is recognised by its items, but a stream can't be read
+        # twice, so for one of those set jobid to something that changes
+        # whenever its contents do.
+        self.checkpointdir = None
+        self.resume = False
+        self.jobid = None
+        # Jobs still to run after the current one (see run_jobs)
+        self.jobs = iter(())
+        self.job = 0
+        self.job_results = []
+
+    def run_server(self, password="", port=DEFAULT_PORT, resume=False):
+        """Serve the job to connecting clients and return its results.
+
+        With checkpointdir set and resume true, results already logged there
+        by an earlier run of the same job are reused and only the missing
+        tasks are handed out; otherwise the log is started afresh.  A job is
+        the same if its functions, jobid and, for a mapping datasource, the
+        datasource's items are; a streamed datasource is trusted to be.
+        """
+        for _ in self.serve(password, port, resume):
+            pass
+        return self.taskmanager.results
 
-    def run_server(self, password="", port=DEFAULT_PORT):
+    def iter_results(self, password="", port=DEFAULT_PORT, resume=False):
+        """Serve the job like run_server, yielding each (key, result) as it
+        is reduced rather than returning them all at the end."""
+        self.delivered = collections.deque()
+        try:
+            for _ in self.serve(password, port, resume):
+                while self.delivered:
+                    yield self.delivered.popleft()
+        finally:
+            self.delivered = None
+
+    def serve(self, password, port, resume):
+        # One step of the event loop per iteration
         self.password = password
+        self.resume = resume
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.bind(("", port))
         self.listen(1)
         try:
-            asyncore.loop(map=self.socket_map)
+            while self.socket_map:
+                asyncore.loop(timeout=TICK_INTERVAL, map=self.socket_map, count=1)
+                self.tick()
+                yield
         except:
             asyncore.close_all()
             raise
+        finally:
+            if self.resultsink:
+                self.resultsink.close()
+            if self.statsfile:
+                self.dump_stats()
+
+    def deliver(self, key, result):
+        if self.resultfn:
+            self.resultfn(key, result)
+        if self.resultsink:
+            self.resultsink.write(key, result)
+        if self.delivered is not None:
+            self.delivered.append((key, result))
+
+    def run_jobs(self, jobs, password="", port=DEFAULT_PORT, resume=False):
+        """Run each Job in turn and return the list of their results.
+
+        Workers stay connected from one job to the next, and functions they
+        have already received are not sent to them again.  jobs may be any
+        iterable, including a generator that produces jobs as it goes.
+        """
+        self.jobs = iter(jobs)
+        self.job_results = []
+        job = next(self.jobs, None)
+        if job is None:
+            return []
+        self.start_job(job)
+        self.job_results.append(self.run_server(password, port, resume))
+        return self.job_results
+
+    def start_job(self, job):
+        self.job += 1
+        self.mapfn = job.mapfn
+        self.reducefn = job.reducefn
+        self.collectfn = job.collectfn
+        self.datasource = job.datasource
+        self.jobid = job.jobid
+
+    def next_job(self):
+        job = next(self.jobs, None)
+        if job is None:
+            return False
+        logging.info("Starting job %d" % (self.job + 1))
+        self.job_results.append(self.taskmanager.results)
+        self.start_job(job)
+        # Workers still busy with the previous job are set up for this one
+        # when they report back
+        for channel in self.socket_map.values():
+            if isinstance(channel, ServerChannel) and channel.auth == "Done" and not channel.busy:
+                channel.post_auth_init()
+        return True
+
+    def tick(self):
+        self.taskmanager.tick()
+        if self.statsfile and time.time() - self.stats_dumped >= self.statsinterval:
+            self.dump_stats()
+
+    def get_stats(self):
+        return self.stats.snapshot(self.taskmanager)
+
+    def dump_stats(self):
+        self.stats_dumped = time.time()
+        # Write then rename so readers never see a half-written file
+        with open(self.statsfile + ".tmp", "w") as f:
+            json.dump(self.get_stats(), f, indent=2, sort_keys=True)
+        os.rename(self.statsfile + ".tmp", self.statsfile)
+
+    def run_local(self, workers=None, chunksize=None):
+        """Run the job on a local process pool instead of remote clients.
+
+        Same functions, same results as run_server, but tasks are handed to
+        the pool in chunks and shuffled in this process: no sockets, no
+        authentication and no per-task round-trips.
+        """
+        workers = workers or multiprocessing.cpu_count()
+        if chunksize is None:
+            if hasattr(self.datasource, '__len__'):
+                chunksize = max(1, len(self.datasource) // (workers * 4))
+            else:
+                chunksize = 1
+        functions = [marshal.dumps(fn.func_code) if fn else None
+                     for fn in (self.mapfn, self.reducefn, self.collectfn)]
 
-        return self.taskmanager.results
+        pool = multiprocessing.Pool(workers, _local_init, functions)
+        try:
+            map_results = ShuffleStore(self.shufflebudget, self.shuffledir)
+            map_items = iter_datasource(self.datasource)
+            running = {}
+            while True:
+                # The pool reads its whole input up front, so feed it
+                # inflight items at a time
+                block = list(itertools.islice(map_items, self.inflight))
+                if not block:
+                    break
+                for key, results in pool.imap_unordered(_local_map, block, chunksize):
+                    for (k, values) in results.iteritems():
+                        map_results.add(k, values)
+                    if self.convergencefn:
+                        fold_results(self.reducefn, running, results)
+                        if self.convergencefn(running):
+                            logging.info("Converged; skipping the remaining maps")
+                            pool.terminate()
+                            for item in running.iteritems():
+                                self.deliver(*item)
+                            return running
+            results = {}
+            for key, result in pool.imap_unordered(_local_reduce, map_results.iteritems(), chunksize):
+                self.deliver(key, result)
+                if self.keepresults:
+                    results[key] = result
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            if self.resultsink:
+                self.resultsink.close()
+        pool.close()
+        pool.join()
+
+        return results
+
+    def channels(self):
+        return [channel for channel in self.socket_map.itervalues()
+                if isinstance(channel, ServerChannel) and channel.auth == "Done" and channel.connected]
 
     def handle_accept(self):
         conn, addr = self.accept()
@@ -247,114 +957,1098 @@ class ServerChannel(Protocol):
     def __init__(self, conn, map, server):
         Protocol.__init__(self, conn, map=map)
         self.server = server
+        self.framings = server.framings
+        self.compression = server.compression
+        self.compressmin = server.compressmin
+        self.name = "%s:%d" % self.addr[:2]
+        self.stats = server.stats
+        self.stats.worker_connected(self.name)
+        self.job = None
+        self.busy = False
+        self.functions = set()
+        self.last_seen = time.time()
 
         self.start_auth()
 
     def handle_close(self):
         logging.info("Client disconnected")
+        self.stats.worker_disconnected(self.name)
         self.close()
+        self.server.taskmanager.channel_lost(self)
+
+    def handle_read(self):
+        self.last_seen = time.time()
+        Protocol.handle_read(self)
 
     def start_auth(self):
-        self.send_challenge()
+        self.send_challenge(self.handshake_options())
 
     def start_new_task(self):
         command, data = self.server.taskmanager.next_task(self)
         if command == None:
             return
+        self.job = self.server.job
+        self.busy = command != 'disconnect'
         self.send_command(command, data)
 
     def map_done(self, command, data):
-        self.server.taskmanager.map_done(data)
+        self.server.taskmanager.map_done(data, self)
+        self.server.taskmanager.batch_done(self, 1)
         self.start_new_task()
+        self.server.taskmanager.wake()
 
     def reduce_done(self, command, data):
-        self.server.taskmanager.reduce_done(data)
+        self.server.taskmanager.reduce_done(data, self)
+        self.server.taskmanager.batch_done(self, 1)
+        self.start_new_task()
+        self.server.taskmanager.wake()
+
+    def map_batch_done(self, command, data):
+        self.server.taskmanager.map_batch_done(self, data)
         self.start_new_task()
+        self.server.taskmanager.wake()
+
+    def reduce_batch_done(self, command, data):
+        self.server.taskmanager.reduce_batch_done(self, data)
+        self.start_new_task()
+        self.server.taskmanager.wake()
+
+    def partial_done(self, command, data):
+        self.server.taskmanager.partial_done(data, self)
+        self.start_new_task()
+        self.server.taskmanager.wake()
+
+    def tasks_cancelled(self, command, data):
+        self.server.taskmanager.tasks_cancelled(self, data)
+        self.start_new_task()
+
+    def map_partial(self, command, data):
+        if self.job == self.server.job:
+            self.server.taskmanager.map_partial(self, data)
 
     def process_command(self, command, data=None):
         commands = {
             'mapdone': self.map_done,
             'reducedone': self.reduce_done,
+            'mapbatchdone': self.map_batch_done,
+            'reducebatchdone': self.reduce_batch_done,
+            'partialdone': self.partial_done,
+            'cancelled': self.tasks_cancelled,
+            'mappartial': self.map_partial,
+            'heartbeat': lambda command, data: None,
             }
 
+        if command in TASK_REPLIES:
+            self.busy = False
+            if self.job != self.server.job:
+                logging.info("Discarding %s from a previous job" % command)
+                self.post_auth_init()
+                return
+
         if command in commands:
             commands[command](command, data)
         else:
             Protocol.process_command(self, command, data)
 
     def post_auth_init(self):
-        if self.server.mapfn:
-            self.send_command('mapfn', marshal.dumps(self.server.mapfn.func_code))
-        if self.server.reducefn:
-            self.send_command('reducefn', marshal.dumps(self.server.reducefn.func_code))
-        if self.server.collectfn:
-            self.send_command('collectfn', marshal.dumps(self.server.collectfn.func_code))
+        for name in ('mapfn', 'reducefn', 'collectfn'):
+            self.send_function(name, getattr(self.server, name))
         self.start_new_task()
 
+    def send_function(self, name, fn):
+        if 'fncache' not in self.peer_features:
+            if fn:
+                self.send_command(name, marshal.dumps(fn.func_code))
+            return
+
+        if not fn:
+            self.send_command('function', (name, None, None))
+            return
+        code = marshal.dumps(fn.func_code)
+        digest = hashlib.sha1(code).hexdigest()
+        if digest in self.functions:
+            self.send_command('function', (name, digest, None))
+        else:
+            self.functions.add(digest)
+            self.send_command('function', (name, digest, code))
+
+
+def fold_results(reducefn, running, results):
+    """Reduce one map's output into running, the results so far."""
+    for key, values in results.iteritems():
+        if key in running:
+            values = [running[key]] + list(values)
+        running[key] = reducefn(key, values)
+
+
+def iter_datasource(datasource):
+    """Iterate over a datasource's (key, value) pairs.
+
+    A datasource is either a mapping, or any iterable of (key, value) pairs
+    such as a generator, a LineSource or a ShardSource, which is read only
+    as tasks are handed out.
+    """
+    if hasattr(datasource, 'keys') and hasattr(datasource, '__getitem__'):
+        return ((key, datasource[key]) for key in datasource)
+    return iter(datasource)
+
+
+def datasource_fingerprint(datasource):
+    """Digest of a mapping datasource's items, in any order, or '' for a
+    stream, which can't be read ahead of its tasks."""
+    if not (hasattr(datasource, 'keys') and hasattr(datasource, '__getitem__')):
+        return ''
+    total = 0
+    for item in iter_datasource(datasource):
+        total += int(hashlib.sha1(pickle.dumps(item, pickle.HIGHEST_PROTOCOL)).hexdigest(), 16)
+    return "%d:%x" % (len(datasource), total % (1 << 160))
+
+
+class LineSource(object):
+    """Datasource of the lines of a text file, keyed by (path, line number)."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path) as f:
+            for number, line in enumerate(f):
+                yield (self.path, number), line.rstrip("\n")
+
+
+class ShardSource(object):
+    """Datasource of the files in a directory, one task per file keyed by
+    file name, or one task per line of each file if lines is set."""
+
+    def __init__(self, directory, lines=False):
+        self.directory = directory
+        self.lines = lines
+
+    def __iter__(self):
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not os.path.isfile(path):
+                continue
+            if self.lines:
+                for item in LineSource(path):
+                    yield item
+            else:
+                with open(path) as f:
+                    yield name, f.read()
+
+
+class Job(object):
+    """One map/reduce job for Server.run_jobs."""
+
+    def __init__(self, datasource, mapfn, reducefn, collectfn=None, jobid=None):
+        self.datasource = datasource
+        self.mapfn = mapfn
+        self.reducefn = reducefn
+        self.collectfn = collectfn
+        self.jobid = jobid
+
+
 class TaskManager:
     START = 0
     MAPPING = 1
     REDUCING = 2
     FINISHED = 3
 
+    PHASES = ('map', 'partial', 'reduce')
+
+    # Weight given to the most recent batch when tracking per-key timings
+    BATCH_SMOOTHING = 0.5
+
+    # Once the number of keys left is known, a worker gets at most its
+    # share of the capacity of all workers times the keys left divided by
+    # this, so batches shrink towards the end of a phase
+    GUIDED_FACTOR = 2
+
+    # Number of recent task times kept per phase for speculation
+    LATENCY_WINDOW = 1000
+
     def __init__(self, datasource, server):
         self.datasource = datasource
         self.server = server
         self.state = TaskManager.START
+        self.batch_sizes = {}
+        self.batch_started = {}
+        self.batch_key_times = {}
+        self.bucket_keys = {}
+        self.bucket_sizes = {}
+        self.ready_buckets = []
+        self.working_partials = {}
+        self.partial_count = 0
+        self.leases = dict((phase, {}) for phase in self.PHASES)
+        self.latencies = dict((phase, collections.deque(maxlen=self.LATENCY_WINDOW)) for phase in self.PHASES)
+        self.idle_channels = set()
+        self.ticked = time.time()
+        self.checkpoint = None
+        self.restored_results = {}
+        self.stashed = {}
+        self.running = {}
+        self.converged = False
+        # Tasks whose worker was lost, to be handed out before anything
+        # else, and when they were lost
+        self.requeued = dict((phase, collections.deque()) for phase in self.PHASES)
+        self.lost_at = dict((phase, {}) for phase in self.PHASES)
+        # Keys of the current phase not handed out yet, if known
+        self.unissued = None
 
     def next_task(self, channel):
         if self.state == TaskManager.START:
-            self.map_iter = iter(self.datasource)
+            self.server.stats.phase_started('map')
+            self.map_iter = iter_datasource(self.datasource)
+            if hasattr(self.datasource, '__len__'):
+                self.unissued = len(self.datasource)
             self.working_maps = {}
-            self.map_results = {}
+            self.map_results = ShuffleStore(self.server.shufflebudget, self.server.shuffledir)
+            if self.server.checkpointdir:
+                self.start_checkpoint()
             #self.waiting_for_maps = []
             self.state = TaskManager.MAPPING
+        if self.state == TaskManager.MAPPING and self.converged:
+            logging.info("Converged; cancelling the remaining maps")
+            self.cancel_maps()
+            self.results = self.running
+            for item in self.running.iteritems():
+                self.server.deliver(*item)
+            self.finish()
         if self.state == TaskManager.MAPPING:
-            try:
-                map_key = self.map_iter.next()
-                map_item = map_key, self.datasource[map_key]
+            # Only clients that listed 'partial' are sent partial reduces;
+            # the others keep mapping
+            partials = 'partial' in channel.peer_features
+            if partials:
+                partial = self.next_partial(channel)
+                if partial:
+                    return partial
+                for task_id in self.requeued_keys('partial', 1):
+                    self.lease(channel, 'partial', [task_id])
+                    return ('partial', (task_id, self.working_partials[task_id]))
+            map_items = [(key, self.working_maps[key]) for key in self.requeued_keys('map', self.batch_size(channel))]
+            size = self.batch_size(channel) - len(map_items)
+            if self.server.inflight:
+                size = min(size, self.server.inflight - len(self.working_maps))
+            for map_item in itertools.islice(self.map_iter, max(size, 0)):
                 self.working_maps[map_item[0]] = map_item[1]
-                return ('map', map_item)
-            except StopIteration:
-                if len(self.working_maps) > 0:
-                    key = random.choice(self.working_maps.keys())
-                    return ('map', (key, self.working_maps[key]))
-                self.state = TaskManager.REDUCING
-                self.reduce_iter = self.map_results.iteritems()
-                self.working_reduces = {}
-                self.results = {}
+                map_items.append(map_item)
+                if self.unissued:
+                    self.unissued -= 1
+            if not map_items:
+                keys = self.speculate(channel, 'map', self.batch_size(channel))
+                map_items = [(key, self.working_maps[key]) for key in keys]
+            if map_items:
+                return self.dispatch(channel, 'map', map_items)
+            if partials:
+                for task_id in self.speculate(channel, 'partial', 1):
+                    self.lease(channel, 'partial', [task_id])
+                    return ('partial', (task_id, self.working_partials[task_id]))
+            if self.working_partials and not any('partial' in other.peer_features for other in self.server.channels()):
+                self.recall_partials()
+            if len(self.working_maps) > 0 or len(self.working_partials) > 0:
+                return self.idle(channel)
+            self.state = TaskManager.REDUCING
+            self.server.stats.phase_started('reduce')
+            self.reduce_iter = self.map_results.iteritems()
+            self.unissued = None
+            if not self.map_results.runs:
+                self.unissued = len(self.map_results.buffer) - len(self.restored_results)
+            if self.restored_results:
+                self.reduce_iter = (item for item in self.reduce_iter if item[0] not in self.restored_results)
+            self.working_reduces = {}
+            self.results = {}
+            for item in self.restored_results.iteritems():
+                self.add_result(*item)
+            if self.checkpoint:
+                self.checkpoint.write(('phase', 'reduce'))
         if self.state == TaskManager.REDUCING:
-            try:
-                reduce_item = self.reduce_iter.next()
+            size = self.batch_size(channel)
+            reduce_items = [(key, self.working_reduces[key]) for key in self.requeued_keys('reduce', size)]
+            for reduce_item in itertools.islice(self.reduce_iter, size - len(reduce_items)):
                 self.working_reduces[reduce_item[0]] = reduce_item[1]
-                return ('reduce', reduce_item)
-            except StopIteration:
-                if len(self.working_reduces) > 0:
-                    key = random.choice(self.working_reduces.keys())
-                    return ('reduce', (key, self.working_reduces[key]))
-                self.state = TaskManager.FINISHED
+                reduce_items.append(reduce_item)
+                if self.unissued:
+                    self.unissued -= 1
+            if not reduce_items:
+                reduce_items = [(key, self.working_reduces[key]) for key in self.speculate(channel, 'reduce', size)]
+            if reduce_items:
+                return self.dispatch(channel, 'reduce', reduce_items)
+            if len(self.working_reduces) > 0:
+                return self.idle(channel)
+            self.finish()
         if self.state == TaskManager.FINISHED:
+            if self.server.next_job():
+                return (None, None)
             self.server.handle_close()
             return ('disconnect', None)
 
-    def map_done(self, data):
+    def finish(self):
+        self.state = TaskManager.FINISHED
+        self.server.stats.phase_started('finished')
+        if self.checkpoint:
+            self.checkpoint.write(('phase', 'finished'))
+            self.checkpoint.close()
+
+    def converge(self, results):
+        fold_results(self.server.reducefn, self.running, results)
+        if self.server.convergencefn(self.running):
+            self.converged = True
+
+    def cancel_maps(self):
+        for key, holders in self.leases['map'].iteritems():
+            for channel in holders:
+                if channel.connected and 'cancel' in channel.peer_features:
+                    channel.send_command('cancel', [('map', key)])
+        self.leases['map'].clear()
+        self.working_maps.clear()
+        self.map_iter = iter(())
+
+    def start_checkpoint(self):
+        codes = [marshal.dumps(fn.func_code) if fn else '' for fn in
+                 (self.server.mapfn, self.server.reducefn, self.server.collectfn)]
+        identity = codes + [datasource_fingerprint(self.server.datasource), str(self.server.jobid or '')]
+        job = hashlib.sha1('\0'.join(identity)).hexdigest()
+        path = os.path.join(self.server.checkpointdir, "job-%d.log" % self.server.job)
+        self.checkpoint = Checkpoint(path)
+
+        completed_maps = set()
+        for record in self.checkpoint.open(job, self.server.resume):
+            if record[0] == 'map':
+                completed_maps.add(record[1])
+                for (key, values) in record[2].iteritems():
+                    self.map_results.add(key, values)
+                if self.server.convergencefn:
+                    self.converge(record[2])
+            elif record[0] == 'reduce':
+                self.restored_results[record[1]] = record[2]
+        if completed_maps or self.restored_results:
+            logging.info("Resuming with %d maps and %d reduces already done" %
+                         (len(completed_maps), len(self.restored_results)))
+            self.map_iter = (item for item in self.map_iter if item[0] not in completed_maps)
+
+    def next_partial(self, channel):
+        while self.ready_buckets:
+            bucket = self.ready_buckets.pop(0)
+            partial_items = []
+            for key in self.bucket_keys.pop(bucket):
+                values = self.map_results.pop(key)
+                if values:
+                    partial_items.append((key, values))
+            del self.bucket_sizes[bucket]
+            if partial_items:
+                self.partial_count += 1
+                self.working_partials[self.partial_count] = partial_items
+                self.lease(channel, 'partial', [self.partial_count])
+                return ('partial', (self.partial_count, partial_items))
+        return None
+
+    def recall_partials(self):
+        # Nobody left can run the partial reduces still out, so their values
+        # go back to be reduced with the rest
+        for task_id, partial_items in self.working_partials.iteritems():
+            for key, values in partial_items:
+                self.map_results.add(key, values)
+            self.leases['partial'].pop(task_id, None)
+            self.lost_at['partial'].pop(task_id, None)
+        logging.warning("No client left runs partial reduces; recalled %d" % len(self.working_partials))
+        self.working_partials = {}
+
+    def add_map_results(self, key, values):
+        self.map_results.add(key, values)
+        if not self.server.partitions:
+            return
+
+        bucket = hash(key) % self.server.partitions
+        if bucket not in self.bucket_keys:
+            self.bucket_keys[bucket] = set()
+            self.bucket_sizes[bucket] = 0
+        self.bucket_keys[bucket].add(key)
+        self.bucket_sizes[bucket] += len(values)
+        if self.bucket_sizes[bucket] >= self.server.partialsize and bucket not in self.ready_buckets:
+            self.ready_buckets.append(bucket)
+
+    def dispatch(self, channel, command, items):
+        self.lease(channel, command, [item[0] for item in items])
+        self.batch_started[channel] = time.time()
+        if self.server.batchsize <= 1 and channel.peer_workers <= 1:
+            return (command, items[0])
+        return (command + 'batch', items)
+
+    def idle(self, channel):
+        # Nothing worth doing right now; wake() asks again later
+        self.idle_channels.add(channel)
+        return (None, None)
+
+    def wake(self):
+        # The fastest workers get first pick
+        channels = sorted(self.idle_channels, key=self.capacity, reverse=True)
+        self.idle_channels.clear()
+        for channel in channels:
+            if channel.connected:
+                channel.start_new_task()
+
+    def tick(self):
+        # Running tasks age while nothing else happens, so idle workers
+        # need to be offered speculative copies every so often.
+        if time.time() - self.ticked >= TICK_INTERVAL:
+            self.ticked = time.time()
+            self.check_heartbeats()
+            self.wake()
+
+    def working(self, phase):
+        return {
+            'map': getattr(self, 'working_maps', {}),
+            'partial': self.working_partials,
+            'reduce': getattr(self, 'working_reduces', {}),
+            }[phase]
+
+    def channel_lost(self, channel):
+        # Tasks nobody else is running a copy of go to the front of the queue
+        self.idle_channels.discard(channel)
+        self.batch_started.pop(channel, None)
+        for stashed in self.stashed.itervalues():
+            stashed.pop(channel, None)
+        now = time.time()
+        requeued = 0
+        for phase in self.PHASES:
+            for key, holders in self.leases[phase].iteritems():
+                if holders.pop(channel, None) is None:
+                    continue
+                if not any(other.connected for other in holders):
+                    self.requeued[phase].append(key)
+                    self.lost_at[phase][key] = now
+                    self.server.stats.requeued(phase)
+                    requeued += 1
+        if requeued:
+            logging.warning("Lost %s; handing its %d tasks to other workers" % (channel.name, requeued))
+            self.wake()
+
+    def requeued_keys(self, phase, size):
+        working = self.working(phase)
+        queue = self.requeued[phase]
+        keys = []
+        while queue and len(keys) < size:
+            key = queue.popleft()
+            # Skip tasks that have finished or been picked up again since
+            holders = self.leases[phase].get(key, {})
+            if key in working and not any(holder.connected for holder in holders):
+                keys.append(key)
+                self.server.stats.redispatched(phase)
+        return keys
+
+    def check_heartbeats(self):
+        timeout = self.server.heartbeattimeout
+        if not timeout:
+            return
+        now = time.time()
+        holders = set()
+        for leases in self.leases.itervalues():
+            for channels in leases.itervalues():
+                holders.update(channels)
+        # Only clients that listed 'heartbeat' in their auth reply send them;
+        # the others are only given up on when their connection drops
+        for channel in holders:
+            if (channel.connected and 'heartbeat' in channel.peer_features and
+                    now - channel.last_seen > timeout):
+                logging.warning("No heartbeat from %s for %d seconds" % (channel.name, now - channel.last_seen))
+                channel.handle_close()
+
+    def lease(self, channel, phase, keys):
+        now = time.time()
+        # An idle client sends nothing, so its silence is only counted from
+        # when it is handed work
+        channel.last_seen = now
+        for key in keys:
+            self.leases[phase].setdefault(key, {})[channel] = now
+
+    def release(self, channel, phase, key):
+        # The first copy of a task to finish wins: record how long it took
+        # and tell the workers running the other copies to stop.
+        holders = self.leases[phase].pop(key, {})
+        started = holders.pop(channel, None)
+        if started is not None:
+            self.latencies[phase].append(time.time() - started)
+            self.server.stats.task_done(phase, channel.name, time.time() - started)
+        lost = self.lost_at[phase].pop(key, None)
+        if lost is not None:
+            self.server.stats.recovered(phase, time.time() - lost)
+        for other in holders:
+            if other.connected and 'cancel' in other.peer_features:
+                other.send_command('cancel', [(phase, key)])
+
+    def queue_depths(self):
+        depths = {}
+        for phase in self.PHASES:
+            depths[phase] = {
+                'running': len(self.working(phase)),
+                'copies': sum(len(holders) for holders in self.leases[phase].itervalues()),
+                'requeued': len(self.requeued[phase]),
+                }
+        depths['partial']['ready'] = len(self.ready_buckets)
+        depths['idle_workers'] = len(self.idle_channels)
+        return depths
+
+    def speculation_threshold(self, phase):
+        latencies = self.latencies[phase]
+        if len(latencies) < max(1, self.server.speculatemin):
+            return None
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(self.server.speculatepercentile * len(ordered)))
+        return ordered[index] * self.server.speculatefactor
+
+    def speculate(self, channel, phase, size):
+        threshold = self.speculation_threshold(phase)
+        now = time.time()
+        candidates = []
+        for key, holders in self.leases[phase].iteritems():
+            if channel in holders:
+                continue
+            running = [started for holder, started in holders.iteritems() if holder.connected]
+            if running:
+                if threshold is None or len(running) > self.server.speculatecopies:
+                    continue
+                if now - min(running) < threshold:
+                    continue
+            # Tasks nobody is running any more go first, then the oldest
+            candidates.append((min(running) if running else 0, key))
+        candidates.sort()
+        keys = [key for started, key in candidates[:size]]
+        if keys:
+            logging.info("Speculatively re-issuing %d %s tasks" % (len(keys), phase))
+        return keys
+
+    def tasks_cancelled(self, channel, data):
+        for phase, key in data or ():
+            if key in self.leases[phase]:
+                self.leases[phase][key].pop(channel, None)
+            if phase == 'map' and key in self.stashed:
+                self.stashed[key].pop(channel, None)
+        self.batch_started.pop(channel, None)
+
+    def batch_size(self, channel):
+        # Clients running several workers get that many times the keys
+        workers = channel.peer_workers
+        if self.server.batchsize <= 1:
+            return workers
+        if self.server.batchtime:
+            size = self.batch_sizes.get(channel, workers)
+        else:
+            # Full batches for the fastest workers, smaller ones for the rest
+            capacities = [self.capacity(other) for other in self.server.channels()] or [1.0]
+            size = int(math.ceil(self.server.batchsize * workers * self.capacity(channel) / max(capacities)))
+        if self.unissued is not None:
+            share = self.capacity(channel) / sum(self.capacity(other) for other in self.server.channels() or [channel])
+            size = min(size, int(math.ceil(self.unissued * share / self.GUIDED_FACTOR)))
+        return max(1, size)
+
+    def capacity(self, channel):
+        # Keys per second: as measured once a worker has finished some,
+        # before that what it advertised, scaled by how what the measured
+        # workers advertised compares to what they actually do.
+        if channel in self.batch_key_times:
+            return 1.0 / self.batch_key_times[channel]
+        measured = [other for other in self.batch_key_times if other.connected]
+        advertised = self.advertised_capacity(channel)
+        if measured:
+            return advertised * (sum(1.0 / self.batch_key_times[other] for other in measured) /
+                                 sum(self.advertised_capacity(other) for other in measured))
+        return advertised
+
+    def advertised_capacity(self, channel):
+        score = channel.peer_score
+        if not score:
+            # Clients too old to benchmark themselves count as average
+            scores = [other.peer_score for other in self.server.channels() if other.peer_score]
+            score = float(sum(scores)) / len(scores) if scores else 1.0
+        return float(channel.peer_workers * score)
+
+    def batch_done(self, channel, count):
+        started = self.batch_started.pop(channel, None)
+        if started is None or not count:
+            return
+
+        key_time = max(time.time() - started, 1e-6) / count
+        if channel in self.batch_key_times:
+            key_time = (self.BATCH_SMOOTHING * key_time +
+                        (1 - self.BATCH_SMOOTHING) * self.batch_key_times[channel])
+        self.batch_key_times[channel] = key_time
+        if not self.server.batchtime:
+            return
+        size = int(self.server.batchtime / key_time)
+        self.batch_sizes[channel] = max(1, min(self.server.batchsize * channel.peer_workers, size))
+        logging.debug("Batch size for %s is now %d" % (channel.addr, self.batch_sizes[channel]))
+
+    def map_partial(self, channel, data):
+        # Output a map sent early is held back until that copy of the map
+        # finishes first, so nothing from a copy that loses is ever counted
+        if channel in self.leases['map'].get(data[0], {}):
+            self.stashed.setdefault(data[0], {}).setdefault(channel, []).append(data[1])
+
+    def map_done(self, data, channel=None):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_maps:
+            self.server.stats.duplicate('map')
             return
 
-        for (key, values) in data[1].iteritems():
-            if key not in self.map_results:
-                self.map_results[key] = []
-            self.map_results[key].extend(values)
+        self.release(channel, 'map', data[0])
+        results = data[1]
+        stashed = self.stashed.pop(data[0], {}).get(channel)
+        if stashed:
+            results = {}
+            for partial in stashed + [data[1]]:
+                for (key, values) in partial.iteritems():
+                    results.setdefault(key, []).extend(values)
+        for (key, values) in results.iteritems():
+            self.add_map_results(key, values)
         del self.working_maps[data[0]]
+        if self.checkpoint:
+            self.checkpoint.write(('map', data[0], results))
+        if self.server.convergencefn:
+            self.converge(results)
 
-    def reduce_done(self, data):
+    def reduce_done(self, data, channel=None):
         # Don't use the results if they've already been counted
         if not data[0] in self.working_reduces:
+            self.server.stats.duplicate('reduce')
             return
 
-        self.results[data[0]] = data[1]
+        self.release(channel, 'reduce', data[0])
+        self.add_result(data[0], data[1])
         del self.working_reduces[data[0]]
+        if self.checkpoint:
+            self.checkpoint.write(('reduce', data[0], data[1]))
+
+    def add_result(self, key, result):
+        if self.server.keepresults:
+            self.results[key] = result
+        self.server.deliver(key, result)
+
+    def partial_done(self, data, channel=None):
+        # Don't use the results if they've already been counted
+        if not data[0] in self.working_partials:
+            self.server.stats.duplicate('partial')
+            return
+
+        self.release(channel, 'partial', data[0])
+        # Partial results go back in as values and are reduced again later
+        for (key, result) in data[1]:
+            self.map_results.add(key, [result])
+        del self.working_partials[data[0]]
+
+    def map_batch_done(self, channel, data):
+        for item in data:
+            self.map_done(item, channel)
+        self.batch_done(channel, len(data))
+
+    def reduce_batch_done(self, channel, data):
+        for item in data:
+            self.reduce_done(item, channel)
+        self.batch_done(channel, len(data))
+
+
+def parse_codec(spec):
+    name, _, level = spec.partition('-')
+    if level:
+        return name, int(level)
+    return name, CODECS[name][2] if name in CODECS else None
+
+
+class Stats(object):
+    """Counters for a running job.
+
+    Traffic is counted per command (messages, bytes on the wire and time
+    spent pickling or unpickling on the coordinator), tasks per phase and
+    per worker (dispatch-to-completion seconds), how many results
+    arrived for tasks another worker had already finished, and how tasks
+    of lost workers were requeued and how long they took to recover.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.commands = {}
+        self.tasks = {}
+        self.duplicates = {}
+        self.workers = {}
+        self.compression = {}
+        self.recovery = {}
+
+    def phase_started(self, phase):
+        self.phases[phase] = time.time() - self.started
+
+    def command(self, command):
+        if command not in self.commands:
+            self.commands[command] = {
+                'sent': 0, 'sent_bytes': 0, 'received': 0, 'received_bytes': 0, 'pickle_seconds': 0.0,
+                }
+        return self.commands[command]
+
+    def sent(self, command, nbytes, seconds=0.0):
+        counts = self.command(command)
+        counts['sent'] += 1
+        counts['sent_bytes'] += nbytes
+        counts['pickle_seconds'] += seconds
+
+    def received(self, command, nbytes, seconds=0.0):
+        counts = self.command(command)
+        counts['received'] += 1
+        counts['received_bytes'] += nbytes
+        counts['pickle_seconds'] += seconds
+
+    def codec_counts(self, command):
+        if command not in self.compression:
+            self.compression[command] = {
+                'frames': 0, 'raw_bytes': 0, 'compressed_bytes': 0,
+                'compress_seconds': 0.0, 'decompress_seconds': 0.0,
+                }
+        return self.compression[command]
+
+    def compressed(self, command, raw_bytes, compressed_bytes, seconds):
+        counts = self.codec_counts(command)
+        counts['frames'] += 1
+        counts['raw_bytes'] += raw_bytes
+        counts['compressed_bytes'] += compressed_bytes
+        counts['compress_seconds'] += seconds
+
+    def decompressed(self, command, compressed_bytes, raw_bytes, seconds):
+        counts = self.codec_counts(command)
+        counts['frames'] += 1
+        counts['raw_bytes'] += raw_bytes
+        counts['compressed_bytes'] += compressed_bytes
+        counts['decompress_seconds'] += seconds
+
+    def worker_connected(self, name):
+        self.workers[name] = {'connected': time.time(), 'disconnected': None, 'tasks': {}, 'task_seconds': 0.0}
+
+    def worker_disconnected(self, name):
+        if name in self.workers:
+            self.workers[name]['disconnected'] = time.time()
+
+    def task_done(self, phase, worker, seconds):
+        if phase not in self.tasks:
+            self.tasks[phase] = {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        counts = self.tasks[phase]
+        counts['count'] += 1
+        counts['seconds'] += seconds
+        counts['max_seconds'] = max(counts['max_seconds'], seconds)
+        if worker in self.workers:
+            tasks = self.workers[worker]['tasks']
+            tasks[phase] = tasks.get(phase, 0) + 1
+            self.workers[worker]['task_seconds'] += seconds
+
+    def duplicate(self, phase):
+        self.duplicates[phase] = self.duplicates.get(phase, 0) + 1
+
+    def recovery_counts(self, phase):
+        if phase not in self.recovery:
+            self.recovery[phase] = {'requeued': 0, 'redispatched': 0, 'recovered': 0,
+                                    'recovery_seconds': 0.0, 'max_recovery_seconds': 0.0}
+        return self.recovery[phase]
+
+    def requeued(self, phase):
+        self.recovery_counts(phase)['requeued'] += 1
+
+    def redispatched(self, phase):
+        self.recovery_counts(phase)['redispatched'] += 1
+
+    def recovered(self, phase, seconds):
+        # From losing the worker running a task to another finishing it
+        counts = self.recovery_counts(phase)
+        counts['recovered'] += 1
+        counts['recovery_seconds'] += seconds
+        counts['max_recovery_seconds'] = max(counts['max_recovery_seconds'], seconds)
+
+    def snapshot(self, taskmanager=None):
+        now = time.time()
+        tasks = {}
+        for phase, counts in self.tasks.iteritems():
+            tasks[phase] = dict(counts, mean_seconds=counts['seconds'] / counts['count'])
+            if taskmanager:
+                latencies = sorted(taskmanager.latencies[phase])
+                for percentile in (50, 90, 99):
+                    if latencies:
+                        index = min(len(latencies) - 1, len(latencies) * percentile // 100)
+                        tasks[phase]['p%d_seconds' % percentile] = latencies[index]
+        workers = {}
+        for name, worker in self.workers.iteritems():
+            elapsed = (worker['disconnected'] or now) - worker['connected']
+            completed = sum(worker['tasks'].itervalues())
+            workers[name] = {
+                'connected_seconds': elapsed,
+                'tasks': dict(worker['tasks']),
+                'task_seconds': worker['task_seconds'],
+                'tasks_per_second': completed / elapsed if elapsed > 0 else 0.0,
+                'disconnected': worker['disconnected'] is not None,
+                }
+        snapshot = {
+            'elapsed_seconds': now - self.started,
+            'phases_started_at': dict(self.phases),
+            'commands': dict((command, dict(counts)) for command, counts in self.commands.iteritems()),
+            'tasks': tasks,
+            'duplicates_discarded': dict(self.duplicates),
+            'recovery': dict((phase, dict(counts)) for phase, counts in self.recovery.iteritems()),
+            'workers': workers,
+            'compression': dict(
+                (command, dict(counts, ratio=float(counts['raw_bytes']) / max(1, counts['compressed_bytes'])))
+                for command, counts in self.compression.iteritems()),
+            }
+        if taskmanager:
+            snapshot['queues'] = taskmanager.queue_depths()
+        return snapshot
+
+
+class Checkpoint(object):
+    """Append-only log of a job's completed tasks.
+
+    Records are pickled and written by a background thread, which takes
+    everything queued since its last write in one go and flushes once per
+    batch, so logging a result costs the caller no more than a queue put.
+    A record cut short by a crash is dropped when the log is reopened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = Queue()
+        self.thread = None
+        self.file = None
+
+    def open(self, job, resume=False):
+        """Start logging for job, returning the records kept from before."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        records = []
+        good = 0
+        if resume and os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                unpickler = pickle.Unpickler(f)
+                while True:
+                    try:
+                        record = unpickler.load()
+                    except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                        break
+                    if not records and record != ('job', job):
+                        logging.warning("Checkpoint %s is for another job; starting afresh" % self.path)
+                        break
+                    records.append(record)
+                    good = f.tell()
+        self.file = open(self.path, "ab" if records else "wb")
+        self.file.truncate(good)
+        if not records:
+            self.write(('job', job))
+        self.thread = threading.Thread(target=self.run, name="checkpoint")
+        self.thread.daemon = True
+        self.thread.start()
+        return records[1:]
+
+    def write(self, record):
+        self.queue.put(record)
+
+    def run(self):
+        pickler = pickle.Pickler(self.file, pickle.HIGHEST_PROTOCOL)
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            for record in batch:
+                if record is None:
+                    self.file.close()
+                    return
+                pickler.dump(record)
+                pickler.clear_memo()
+            self.file.flush()
+
+    def close(self):
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class ShardedSink(object):
+    """Writes (key, result) pairs to a directory of shard files, each key to
+    the shard its hash picks.  read_shards reads them back."""
+
+    def __init__(self, directory, shards=16):
+        self.directory = directory
+        self.shards = shards
+        self.files = None
+
+    def write(self, key, result):
+        if self.files is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.files = [open(os.path.join(self.directory, "part-%05d" % i), "wb") for i in range(self.shards)]
+        pickle.dump((key, result), self.files[hash(key) % self.shards], pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        for f in self.files or ():
+            f.close()
+        self.files = None
+
+
+def read_shards(directory):
+    """Iterate over the (key, result) pairs a ShardedSink wrote to directory."""
+    for name in sorted(os.listdir(directory)):
+        if not name.startswith("part-"):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    break
+
+
+class ShuffleStore(object):
+    """Intermediate map output, grouped by key.
+
+    Values are buffered in memory until their estimated size passes the
+    budget, then written to a temporary file as a run sorted by key.
+    iteritems() k-way merges the runs with whatever is still buffered, so
+    only one key's values are materialized at a time.
+
+    Runs are kept in tiers: once the newest fanin runs are all of one tier
+    they are merged into a single run of the next, so no merge reads more
+    than fanin runs and the files held open grow with the logarithm of the
+    intermediate data size rather than with it.
+    """
+
+    fanin = 64
+
+    def __init__(self, budget=None, directory=None):
+        self.budget = budget
+        self.directory = directory
+        self.buffer = {}
+        self.buffered = 0
+        # (tier, file) pairs, oldest first; tiers never increase along it
+        self.runs = []
+
+    def add(self, key, values):
+        if key not in self.buffer:
+            self.buffer[key] = []
+            if self.budget:
+                self.buffered += sys.getsizeof(key)
+        self.buffer[key].extend(values)
+        if self.budget:
+            # Shallow sizes only: this is a trigger, not an accounting
+            self.buffered += sum(sys.getsizeof(value) for value in values)
+            if self.buffered > self.budget:
+                self.spill()
+
+    def pop(self, key):
+        """Remove and return the values for key that are still in memory."""
+        values = self.buffer.pop(key, [])
+        if self.budget and values:
+            self.buffered -= sys.getsizeof(key) + sum(sys.getsizeof(value) for value in values)
+        return values
+
+    def spill(self):
+        run = self.write_run((key, self.buffer[key]) for key in sorted(self.buffer))
+        logging.info("Spilled %d keys to shuffle run %d" % (len(self.buffer), len(self.runs)))
+        self.runs.append((0, run))
+        self.buffer = {}
+        self.buffered = 0
+        self.compact()
+
+    def compact(self):
+        while len(self.runs) >= self.fanin and self.runs[-self.fanin][0] == self.runs[-1][0]:
+            tier = self.runs[-1][0]
+            group = [run for _, run in self.runs[-self.fanin:]]
+            del self.runs[-self.fanin:]
+            run = self.write_run(self.merge([self.read_run(index, run) for index, run in enumerate(group)]))
+            for old in group:
+                old.close()
+            logging.info("Merged %d shuffle runs into one of tier %d" % (len(group), tier + 1))
+            self.runs.append((tier + 1, run))
+
+    def write_run(self, items):
+        run = tempfile.TemporaryFile(prefix="mincemeat-", dir=self.directory)
+        pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+        for key, values in items:
+            pickler.dump((key, values))
+            pickler.clear_memo()
+        return run
+
+    def read_run(self, index, run):
+        run.seek(0)
+        unpickler = pickle.Unpickler(run)
+        while True:
+            try:
+                key, values = unpickler.load()
+            except EOFError:
+                break
+            yield key, index, values
+
+    def merge(self, streams):
+        # The stream index breaks ties between equal keys so values never
+        # get compared, and keeps each key's values oldest first.
+        merged = heapq.merge(*streams)
+        for key, items in itertools.groupby(merged, lambda item: item[0]):
+            values = []
+            for item in items:
+                values.extend(item[2])
+            yield key, values
+
+    def iteritems(self):
+        if not self.runs:
+            return self.buffer.iteritems()
+        return self.merged_items()
+
+    def merged_items(self):
+        # The in-memory buffer acts as the newest run.
+        streams = [self.read_run(index, run) for index, (_, run) in enumerate(self.runs)]
+        streams.append((key, len(self.runs), self.buffer[key]) for key in sorted(self.buffer))
+        try:
+            for key, values in self.merge(streams):
+                yield key, values
+        finally:
+            for _, run in self.runs:
+                run.close()
+            self.runs = []
+            self.buffer = {}
+
+
+# Worker side of Server.run_local: each pool process rebuilds the functions
+# once and runs tasks through a Client that never connects anywhere.
+_local_client = None
+
+
+def benchmark(seconds=0.1):
+    """Score this machine's speed as thousands of loop passes per second."""
+    passes = 0
+    started = time.time()
+    while time.time() - started < seconds:
+        total = 0
+        for i in xrange(1000):
+            total += i * i
+        passes += 1
+    return passes / (time.time() - started)
+
+
+def _local_init(mapfn, reducefn, collectfn, combinesize=COMBINE_SIZE):
+    global _local_client
+    _local_client = Client()
+    _local_client.combinesize = combinesize
+    if mapfn:
+        _local_client.set_mapfn('mapfn', mapfn)
+    if reducefn:
+        _local_client.set_reducefn('reducefn', reducefn)
+    if collectfn:
+        _local_client.set_collectfn('collectfn', collectfn)
+
+
+def _local_map(item):
+    return _local_client.map_item(item)
+
+
+def _local_reduce(item):
+    return _local_client.reduce_item(item)
+
 
 def run_client():
     parser = argparse.ArgumentParser(usage="%(prog)s [options] server_name")
@@ -362,6 +2056,17 @@ def run_client():
     parser.add_argument("-P", "--port", dest="port", type=int, default=DEFAULT_PORT, help="port")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true")
     parser.add_argument("-V", "--loud", dest="loud", action="store_true")
+    parser.add_argument("--no-compression", dest="compression", action="store_false",
+                        help="refuse compressed payloads")
+    parser.add_argument("-f", "--framing", dest="framing", choices=FRAMINGS, default=None,
+                        help="only accept this wire format from the server")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="processes to run tasks on over the one connection (0 for one per core)")
+    parser.add_argument("--combine-size", dest="combinesize", type=int, default=COMBINE_SIZE,
+                        help="values a key collects within a map before collectfn is applied "
+                             "(0 waits for the whole map)")
+    parser.add_argument("--map-memory", dest="mapbudget", type=int, default=MAP_BUDGET,
+                        help="bytes of map output to buffer before sending it early (0 never does)")
     parser.add_argument("--version", action="version", version="%(prog)s {0}".format(VERSION))
     parser.add_argument("server_name", default="localhost", nargs="?", help="server name")
 
@@ -374,6 +2079,14 @@ def run_client():
 
     client = Client()
     client.password = options.password
+    if options.framing:
+        client.framings = (options.framing,)
+    if not options.compression:
+        client.compression = ()
+    client.combinesize = options.combinesize
+    client.mapbudget = options.mapbudget
+    client.workers = options.workers or multiprocessing.cpu_count()
+    client.score = benchmark()
     client.conn(options.server_name, options.port)
 
 
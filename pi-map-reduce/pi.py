@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 import random
@@ -9,17 +10,53 @@ import mincemeat
 log = logging.getLogger()
 
 
-def get_data(mapsize=10, nummaps=4):
-    return {i: mapsize for i in range(1, nummaps + 1)}
+def get_data(mapsize=10, nummaps=4, seed=None):
+    # every task gets the job's seed, and its key picks its own stream
+    if seed is None:
+        seed = uuid.uuid4().int
+    return {i: (mapsize, seed) for i in range(1, nummaps + 1)}
 
 
 def mapfn(key, value):
     print('mapfn: {0}, {1}'.format(key, value))
+    # runs on the workers, so everything it needs is imported here
+    import os
     import random
-    import uuid
-    random.seed(uuid.uuid4())
-    inside = sum((random.random() ** 2 + random.random() ** 2) <= 1. for i in xrange(value))
-    yield 'totals', (inside, value)
+    import socket
+    import time
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    darts, seed = value
+    block = 1000000
+    started = time.time()
+    if numpy is not None:
+        if hasattr(numpy.random, 'SeedSequence'):
+            # same stream as SeedSequence(seed).spawn(...)[key]
+            kernel = 'numpy'
+            rng = numpy.random.default_rng(numpy.random.SeedSequence(seed, spawn_key=(key,)))
+            draw = rng.random
+        else:
+            kernel = 'numpy-legacy'
+            words = [(seed >> shift) & 0xffffffff for shift in range(0, 128, 32)]
+            draw = numpy.random.RandomState([key] + words).random_sample
+        inside = 0
+        remaining = darts
+        while remaining:
+            # fixed size blocks keep memory flat however many darts there are
+            n = min(block, remaining)
+            x = draw(n)
+            y = draw(n)
+            inside += int(numpy.count_nonzero(x * x + y * y <= 1.))
+            remaining -= n
+    else:
+        kernel = 'python'
+        rng = random.Random((seed << 32) + key)
+        inside = sum((rng.random() ** 2 + rng.random() ** 2) <= 1. for i in xrange(darts))
+    worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    yield 'totals', (inside, darts)
+    yield ('rate', kernel, worker), (darts, time.time() - started)
 
 
 def reducefn(key, value):
@@ -32,18 +69,50 @@ def reducefn(key, value):
     return inside, total
 
 
+def converged(target):
+    # pi ~= 4p for the fraction p of darts inside, whose standard error
+    # after n darts is sqrt(p(1 - p) / n)
+    def convergencefn(results):
+        if 'totals' not in results:
+            return False
+        inside, total = results['totals']
+        p = float(inside) / total
+        stderr = 4. * (p * (1. - p) / total) ** .5
+        log.info('%d darts, pi ~= %f +/- %f', total, 4. * p, stderr)
+        return stderr <= target
+    return convergencefn
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mapsize', type=int, default=10000000, help='darts thrown per map task')
+    parser.add_argument('--nummaps', type=int, default=1000, help='number of map tasks')
+    parser.add_argument('--local', action='store_true', help='run on a local process pool instead of remote workers')
+    parser.add_argument('--workers', type=int, default=None, help='local pool size (default: one per CPU)')
+    parser.add_argument('--stderr', type=float, default=None,
+                        help='stop once the standard error of the estimate is this small')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the random streams (default: random)')
+    options = parser.parse_args()
+
     server = mincemeat.Server()
-    data = get_data(mapsize=10000000, nummaps=1000)
+    data = get_data(mapsize=options.mapsize, nummaps=options.nummaps, seed=options.seed)
     log.info('data: %s', data)
-    log.info('waiting for workers...')
     server.datasource = data
     server.mapfn = mapfn
     server.reducefn = reducefn
-    results = server.run_server(password='pass')
+    if options.stderr:
+        server.convergencefn = converged(options.stderr)
+    if options.local:
+        results = server.run_local(workers=options.workers)
+    else:
+        log.info('waiting for workers...')
+        results = server.run_server(password='pass')
     inside, total = results['totals']
     print(results, inside, total)
     print('{0}: {1} inside, {2} total, pi ~= {3}'.format('totals', inside, total, 4. * inside / total))
+    for key in sorted(key for key in results if key != 'totals'):
+        darts, seconds = results[key]
+        print('{0} kernel on {1}: {2:.0f} samples/s'.format(key[1], key[2], darts / seconds if seconds else 0.))
 
 
 if __name__ == '__main__':